@@ -2,20 +2,33 @@
 
 # Ctrl-tab to (un)hide
 # Ctrl-n for new
-# Ctrl-o to open
+# Ctrl-o to open, ctrl-page up/down to switch files, ctrl-w to close
 # Ctrl-s to save
 # Ctrl-q to quit
-# Enter or shift-enter to refresh game.
+# Ctrl-t to show timings
+# Ctrl-f to find, ctrl-r to find a regex, ctrl-g for the next match
+# Ctrl-h to replace all matches
+# Ctrl-d for a cursor on the next occurrence, shift-ctrl-d for all of them
+# Ctrl-alt-up/down for a cursor on the line above/below, escape to clear
+# Enter to update the game, shift-enter to restart it.
 # Drag mouse to move camera.
 
+from livecode.runtime import NodePool, SpatialHash
+
 
 class Game():
     def __init__(self):
         self.models = {
-            'player' : loader.load_model('example/ship.bam'),
-            'monster' : loader.load_model('example/monster.bam'),
-            'bullet' : loader.load_model('example/bullet.bam'),
+            'player' : assets.load_model('example/ship.bam'),
+            'monster' : assets.load_model('example/monster.bam'),
+            'bullet' : assets.load_model('example/bullet.bam'),
+        }
+        # Bullets and enemies are recycled instead of copied each spawn.
+        self.pools = {
+            name: NodePool(model) for name, model in self.models.items()
         }
+        # Enemies by position, so bullets only check the ones near them.
+        self.grid = SpatialHash(cell_size=1)
 
         self.player = self.spawn('player')
         self.bullets = []
@@ -31,20 +44,22 @@ class Game():
         base.task_mgr.add(self.update)
 
     def spawn(self, model='player'):
-        return self.models[model].copy_to(render)
+        return self.pools[model].get(render)
 
     def spawn_enemies(self):
         for i in range(10):
-            self.enemies.append(self.spawn('monster'))
-            self.enemies[i].set_x(-10+(i*2))
-            self.enemies[i].set_y(40)
+            enemy = self.spawn('monster')
+            enemy.set_pos(-10+(i*2), 40, 0)
+            self.grid.update_node(enemy)
+            self.enemies.append(enemy)
 
     def hit_enemy(self, bullet):
-        for enemy in self.enemies:
-            if bullet.get_distance(enemy) < 0.5:
-                enemy.detach_node()
-                self.enemies.remove(enemy)
-                return True
+        enemy = self.grid.nearest(bullet.get_x(), bullet.get_y(), 0.5)
+        if enemy:
+            self.grid.remove(enemy)
+            self.enemies.remove(enemy)
+            self.pools['monster'].release(enemy)
+            return True
 
     def update_player(self):
         dt = globalClock.get_dt()
@@ -63,11 +78,14 @@ class Game():
             bullet.set_pos(self.player.get_pos())
             self.bullets.append(bullet)
 
+        alive = []
         for bullet in self.bullets:
             bullet.set_y(bullet, self.bullet_speed*dt)
             if bullet.get_y() > 60 or self.hit_enemy(bullet):
-                bullet.detach_node()
-                self.bullets.remove(bullet)
+                self.pools['bullet'].release(bullet)
+            else:
+                alive.append(bullet)
+        self.bullets = alive
 
     def update(self, task):
         self.update_player()
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from panda3d.core import NodePath, Filename
+from panda3d.core import VirtualFileSystem, get_model_path
+
+
+class AssetCache():
+    # Loaded models kept across Repl reloads, keyed by path and checked
+    # against the file's timestamp. Least recently used models are dropped
+    # once their estimated size goes over max_bytes.
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict() # path: (timestamp, model, size)
+        self.size = 0
+
+    def load_model(self, path):
+        timestamp = file_timestamp(path)
+        cached = self.models.get(path)
+        if cached and cached[0] == timestamp:
+            self.models.move_to_end(path)
+            model = cached[1]
+        else:
+            self.evict(path)
+            model = loader.load_model(path, noCache=True)
+            size = model_size(model)
+            self.models[path] = (timestamp, model, size)
+            self.size += size
+            while self.size > self.max_bytes and len(self.models) > 1:
+                self.evict(next(iter(self.models)))
+        # Hand out a copy, so the cached model is never parented to a
+        # scene graph that gets thrown away.
+        return NodePath(model.node().copy_subgraph())
+
+    def evict(self, path):
+        if path in self.models:
+            timestamp, model, size = self.models.pop(path)
+            self.size -= size
+            model.remove_node()
+
+    def clear(self):
+        for path in list(self.models):
+            self.evict(path)
+
+
+def file_timestamp(path):
+    vfs = VirtualFileSystem.get_global_ptr()
+    filename = Filename(path)
+    if vfs.resolve_filename(filename, get_model_path().get_value()):
+        return vfs.get_file(filename).get_timestamp()
+    return None
+
+def model_size(model):
+    size = 0
+    for node_path in model.find_all_matches('**/+GeomNode'):
+        for geom in node_path.node().get_geoms():
+            for array in geom.get_vertex_data().get_arrays():
+                size += array.get_data_size_bytes()
+            for primitive in geom.get_primitives():
+                size += primitive.get_data_size_bytes()
+    for texture in model.find_all_textures():
+        size += texture.estimate_texture_memory()
+    return size
@@ -0,0 +1,170 @@
+# Replays key events into a TextEditorNode under a headless ShowBase and
+# reports how long each kind of operation takes, including the redraw.
+#
+#   python -m livecode.bench --sizes 100 1000 --output bench.json
+#
+# With --startup N, main.py is also started N times to time how long it
+# takes until the first frame is rendered.
+#
+# A recorded session can be replayed with --replay, a JSON list of events
+# as [event_name, arg, ...], e.g. [["keystroke", "a"], ["enter"]].
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from .headless import make_headless_base, ROOT
+
+
+OPERATIONS = ('add', 'enter', 'paste', 'undo', 'scroll', 'select')
+EVENTS = {
+    'add': [('keystroke', 'a')],
+    'enter': [('enter',)],
+    'paste': [('control-v',)],
+    'undo': [('control-z',)],
+    'scroll': [('page_down',)],
+    'select': [('shift-arrow_down',)],
+}
+
+
+def synthetic_lines(size):
+    with open(ROOT+'/example/__init__.py') as f:
+        source = [line.rstrip('\n') for line in f]
+    return [source[i % len(source)] for i in range(size)]
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times)-1, int(len(times)*p))]
+
+def summary(times):
+    return {
+        'count': len(times),
+        'p50_ms': percentile(times, 0.5)*1000,
+        'p99_ms': percentile(times, 0.99)*1000,
+        'mean_ms': sum(times)/len(times)*1000,
+        'max_ms': max(times)*1000,
+    }
+
+
+def startup_times(count, window_type):
+    times = []
+    command = [
+        sys.executable, 'main.py', '--startup-time',
+        '--window-type', window_type,
+    ]
+    for i in range(count):
+        result = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+        for line in result.stdout.splitlines():
+            if line.startswith('startup_ms:'):
+                times.append(float(line.split()[1])/1000)
+    return times
+
+
+class Benchmark():
+    def __init__(self, window_type='none'):
+        self.base = make_headless_base(window_type)
+        from .editor import TextEditorNode
+        from .highlight import LEXER
+        self.editor = TextEditorNode('bench')
+        # Don't time the lines that are drawn plain until the lexer loads.
+        LEXER.wait()
+        self.editor.scheduler.policy = 'manual'
+
+    def send(self, event, *args):
+        messenger.send(event, list(args))
+
+    def step(self):
+        self.base.task_mgr.step()
+
+    def reset(self, lines):
+        editor = self.editor
+        editor.lines = lines
+        editor.history.clear()
+        editor.x, editor.y = 0, len(lines)//2
+        editor.paste_buffer = lines[:10]
+        editor.refresh()
+        self.step()
+
+    def measure(self, events, repeat):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            for event in events:
+                self.send(*event)
+            self.step()
+            times.append(time.perf_counter() - start)
+        return times
+
+    def run_size(self, size, repeat, replay=None):
+        lines = synthetic_lines(size)
+        results = {}
+        for operation in OPERATIONS:
+            self.reset(lines)
+            if operation == 'undo':
+                # Something to undo for every repetition.
+                self.measure(EVENTS['add'] + EVENTS['enter'], repeat)
+            if operation == 'select':
+                self.send('shift')
+            results[operation] = summary(
+                self.measure(EVENTS[operation], repeat)
+            )
+            if operation == 'select':
+                self.send('shift-up')
+        if replay:
+            self.reset(lines)
+            times = []
+            for event in replay:
+                times.extend(self.measure([event], 1))
+            results['replay'] = summary(times)
+        return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Editor latency benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=[100, 1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--replay', help='JSON file with recorded events')
+    parser.add_argument('--window-type', default='none')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--startup', type=int, default=0,
+        help='amount of cold starts of main.py to time')
+    args = parser.parse_args(args)
+
+    replay = None
+    if args.replay:
+        with open(args.replay) as f:
+            replay = [tuple(event) for event in json.load(f)]
+
+    startup = None
+    if args.startup:
+        # Before the benchmark warms up any caches in this process.
+        startup = summary(startup_times(args.startup, args.window_type))
+        print('startup p50 {:7.1f}ms  max {:7.1f}ms'.format(
+            startup['p50_ms'], startup['max_ms']
+        ))
+
+    bench = Benchmark(args.window_type)
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = bench.run_size(size, args.repeat, replay)
+        for operation, stats in results[str(size)].items():
+            print('{:>7} lines {:<7} p50 {:7.3f}ms  p99 {:7.3f}ms'.format(
+                size, operation, stats['p50_ms'], stats['p99_ms']
+            ))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'time': time.time(),
+            'repeat': args.repeat,
+            'startup': startup,
+            'results': results,
+        }, f, indent=2)
+    print('saved {}!'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import mmap
+from array import array
+from bisect import bisect_right
+from threading import Thread
+
+
+class LineBuffer():
+    # A rope of line chunks. Edits only touch the chunks they land in, and
+    # a line is found by bisecting the chunk start index, so inserting or
+    # deleting in a huge file doesn't move every line after it.
+    chunk_size = 512
+
+    def __init__(self, lines=None):
+        self.chunks = [[]]
+        self.starts = [0]
+        self.length = 0
+        self.mapped = None
+        self.mapped_lines = 0
+        # Called with (start, old_lines, new_lines) after every edit.
+        self.listeners = []
+        if lines:
+            self.splice(0, 0, lines)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.length)
+            if step != 1:
+                return list(self)[i]
+            return self.get(start, stop)
+        c, n = self.locate(self.index(i))
+        return self.chunks[c][n]
+
+    def __setitem__(self, i, line):
+        i = self.index(i)
+        self.splice(i, i+1, [line])
+
+    def index(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('line index out of range')
+        return i
+
+    def locate(self, i):
+        c = bisect_right(self.starts, i) - 1
+        return c, i - self.starts[c]
+
+    def get(self, start, stop):
+        start, stop = max(0, start), min(stop, self.length)
+        if start >= stop:
+            return []
+        c, n = self.locate(start)
+        lines = self.chunks[c][n:n+stop-start]
+        while len(lines) < stop-start:
+            c += 1
+            lines.extend(self.chunks[c][:stop-start-len(lines)])
+        return lines
+
+    def snapshot(self):
+        # A copy that later edits won't touch, for writing out elsewhere.
+        chunks = [
+            chunk[:] if isinstance(chunk, list) else chunk
+            for chunk in self.chunks
+        ]
+        return ChunkView(chunks, self.length)
+
+    def insert(self, i, line):
+        i = min(max(0, i + self.length if i < 0 else i), self.length)
+        self.splice(i, i, [line])
+
+    def append(self, line):
+        self.splice(self.length, self.length, [line])
+
+    def extend(self, lines):
+        self.splice(self.length, self.length, lines)
+
+    def pop(self, i=-1):
+        i = self.index(i)
+        line = self[i]
+        self.splice(i, i+1)
+        return line
+
+    def set_lines(self, lines):
+        if self.mapped:
+            # Drop the mapped lines without reading them all in, just to
+            # tell listeners what was removed.
+            self.mapped.stop()
+            old = ChunkView(self.chunks, self.length)
+            self.chunks, self.starts, self.length = [[]], [0], 0
+            self.mapped = None
+            self.mapped_lines = 0
+            for listener in self.listeners:
+                listener(0, old, [])
+        self.splice(0, self.length, lines)
+
+    def load_mapped(self, filename):
+        # Lines are read straight from the memory-mapped file as they're
+        # needed. The file is indexed in the background, call sync() to
+        # pick up the lines that have been found since.
+        self.set_lines([])
+        self.mapped = MappedFile(filename)
+        self.sync()
+
+    def sync(self):
+        # Lines added by the indexer aren't edits, listeners aren't told.
+        mapped = self.mapped
+        if not mapped:
+            return False
+        available = mapped.line_count
+        if not mapped.done:
+            available -= available % self.chunk_size
+        if available <= self.mapped_lines:
+            return False
+        if self.length == 0:
+            self.chunks = []
+        c = len(self.chunks)
+        for start in range(self.mapped_lines, available, self.chunk_size):
+            stop = min(start+self.chunk_size, available)
+            self.chunks.append(MappedChunk(mapped, start, stop))
+        self.length += available - self.mapped_lines
+        self.mapped_lines = available
+        self.reindex(c)
+        return True
+
+    def splice(self, start, stop, lines=()):
+        lines = list(lines)
+        old = self.get(start, stop)
+        c, a = self.locate(start)
+        d, b = self.locate(stop)
+        if not isinstance(self.chunks[c], list):
+            self.chunks[c] = list(self.chunks[c])
+        if c == d:
+            self.chunks[c][a:b] = lines
+        else:
+            self.chunks[c][a:] = lines + self.chunks[d][b:]
+            del self.chunks[c+1:d+1]
+        self.length += len(lines) - len(old)
+        if c != d or len(lines) != len(old):
+            # Line counts only need fixing up when lines came or went.
+            self.rebalance(c)
+        for listener in self.listeners:
+            listener(start, old, lines)
+        return old
+
+    def rebalance(self, c):
+        chunk = self.chunks[c]
+        size = self.chunk_size
+        if len(chunk) > size*2:
+            self.chunks[c:c+1] = [
+                chunk[i:i+size] for i in range(0, len(chunk), size)
+            ]
+        elif len(chunk) < size//2 and c+1 < len(self.chunks):
+            chunk.extend(self.chunks.pop(c+1))
+            return self.rebalance(c)
+        elif not chunk and len(self.chunks) > 1:
+            self.chunks.pop(c)
+            c = max(0, c-1)
+        self.reindex(c)
+
+    def reindex(self, c):
+        del self.starts[c:]
+        n = self.starts[-1] + len(self.chunks[c-1]) if c > 0 else 0
+        for chunk in self.chunks[c:]:
+            self.starts.append(n)
+            n += len(chunk)
+
+
+class MappedFile():
+    # Line offsets of a memory-mapped file. The first lines are indexed
+    # right away so there's something to show, the rest on a thread.
+    def __init__(self, filename, encoding='utf-8', preindex=1000):
+        self.encoding = encoding
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = array('q', [0]) # Where each line starts.
+        self.position = 0
+        self.done = False
+        self.closed = False
+        self.index(preindex)
+        if not self.done:
+            self.thread = Thread(target=self.index, daemon=True)
+            self.thread.start()
+
+    @property
+    def line_count(self):
+        return len(self.offsets)-1
+
+    def index(self, limit=None):
+        find = self.map.find
+        offsets = self.offsets
+        position = self.position
+        size = len(self.map)
+        while not self.closed:
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            n = find(b'\n', position)
+            if n < 0:
+                if position < size:
+                    offsets.append(size+1)
+                self.done = True
+                break
+            position = n+1
+            offsets.append(position)
+        self.position = position
+
+    def line(self, i):
+        start, end = self.offsets[i], self.offsets[i+1]-1
+        return self.map[start:end].decode(self.encoding, 'replace')
+
+    def stop(self):
+        # The map itself stays open for as long as chunks refer to it.
+        self.closed = True
+
+
+class MappedChunk():
+    # Stands in for a chunk of lines that haven't been edited yet.
+    def __init__(self, mapped, start, stop):
+        self.mapped = mapped
+        self.lines = range(start, stop)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        for i in self.lines:
+            yield self.mapped.line(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.mapped.line(n) for n in self.lines[i]]
+        return self.mapped.line(self.lines[i])
+
+
+class ChunkView():
+    def __init__(self, chunks, length):
+        self.chunks = chunks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
@@ -0,0 +1,49 @@
+class Document():
+    # One open buffer: the editor state that gets swapped in and out when
+    # switching between documents. Files are only read once switched to.
+    STATE = (
+        'buffer', 'highlight', 'history', 'search', 'journal', 'selection',
+        'x', 'y', 'filename', 'large_file',
+    )
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.loaded = filename is None
+        self.state = {}
+        # The lines as last read from or written to disk, to tell our
+        # changes from the ones made there.
+        self.disk = None
+
+    @property
+    def name(self):
+        return self.filename or 'new file'
+
+    def store(self, editor):
+        for name in self.STATE:
+            self.state[name] = getattr(editor, name, None)
+        self.filename = self.state['filename']
+
+    def restore(self, editor):
+        for name, value in self.state.items():
+            setattr(editor, name, value)
+
+    def cache_bytes(self):
+        highlight = self.state.get('highlight')
+        return highlight.cache_bytes if highlight else 0
+
+    def clear_caches(self):
+        highlight = self.state.get('highlight')
+        if highlight:
+            highlight.clear()
+
+
+def limit_caches(documents, max_bytes):
+    # Documents are in order of use, most recent last. Caches of the least
+    # recently used documents are dropped until the total fits the budget,
+    # except for the current document's.
+    total = sum(document.cache_bytes() for document in documents)
+    for document in documents[:-1]:
+        if total <= max_bytes:
+            break
+        total -= document.cache_bytes()
+        document.clear_caches()
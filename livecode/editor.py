@@ -1,6 +1,19 @@
-from .text import TextFileSelectionNode
+import os
+import re
+import atexit
+from panda3d.core import TextNode, PandaNode, TransformState
+from .text import TextFileSelectionNode, TextTiles, Selection
 from .highlight import Highlight
 from .repl import Repl
+from .history import History
+from .scheduler import RunScheduler
+from .storage import FileWriter, Journal
+from .profile import timed, TimingHud
+from .search import Search
+from .buffer import LineBuffer
+from .document import Document, limit_caches
+from .watcher import FileWatcher, diff_lines, merge_lines
+from .server import ReplServer
 
 
 NUMBERS = '0123456789'
@@ -9,55 +22,283 @@ LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 LETTERS = LETTERS + LETTERS.lower()
 LEGAL_CHARACTERS = LETTERS + NUMBERS + SYMBOLS
 
+MATCH_COLOR = (0.45,0.35,0.1,1)
+WORD = re.compile(r'\w+')
+
 def split(l, n): return l[:n], l[n:]
 def clamp(n, low, high): return max(low, min(n, high))
 
 
 class TextEditorNode(TextFileSelectionNode):
-    def __init__(self, name, filename=None, **options):
+    def __init__(self, name, filename=None, others=(), watch=True,
+                 run_delay=None, run_policy='enter', port=None, **options):
         TextFileSelectionNode.__init__(self, name, filename, **options)
         # Only works with monospaces fonts at this time.
         self.font = loader.load_font("fifteen.ttf")
         self.set_font(self.font)
         self.rect_w = self.calc_width(" ")
         self.rect_h = self.get_line_height()
+        # Rows are drawn as separate tiles instead of this node's own text.
+        self.tiles = TextTiles(self, self.rect_h)
         self.tab_size = 4
 
-        self.highlight = Highlight()
+        # Edits only mark the editor dirty, it's redrawn once per frame
+        # right before rendering. Added before the Repl so it survives
+        # reset_showbase().
+        self.dirty = False
+        base.task_mgr.add(self.update, 'editor refresh', sort=49)
+        self.hud = TimingHud()
+        # Takes code from other programs, if given a port to listen on.
+        self.server = None
+        if port is not None:
+            self.server = ReplServer(self, port)
+            base.task_mgr.add(self.server.poll, 'livecode server', sort=48)
         self.repl = Repl()
         self.setup_input()
 
-        self.cursor_card = None
         self.paste_buffer = []
-
-        self.history = []
-        self.history_index = 0
+        # Extra cursors as [x, y], edited along with the main one.
+        self.cursors = []
+
+        self.scheduler = RunScheduler(self.run, run_policy)
+        # Seconds to hold off running a loaded file, so the editor can
+        # show up first. None runs it right away.
+        self.run_delay = run_delay
+        self.writer = FileWriter()
+        # Registered after the writer's, so it runs before that waits.
+        atexit.register(self.close_journals)
+        # Picks up changes made to open files by other programs.
+        self.watcher = FileWatcher() if watch else None
+
+        # Open documents, in order of opening and in order of use.
+        self.documents = []
+        self.recent = []
+        self.cache_budget = 64*1024*1024
+        self.document = self.add_document()
+        self.document.restore(self)
+
+        # A line under the rows for prompts and messages.
+        self.prompting = None
+        self.status = TextNode('status', self)
+        self.add_child(self.status)
+        status_z = -(self.max_rows+1)*self.rect_h
+        PandaNode.set_transform(self.status, TransformState.make_pos((0,0,status_z)))
 
         if filename:
             self.load_file(filename)
+        # Further files are only read once switched to.
+        for other in others:
+            self.add_document(other)
+
+    # Documents
+    def add_document(self, filename=None):
+        # Every document has its own buffer, history and caches.
+        document = Document(filename)
+        buffer = LineBuffer([''])
+        highlight = Highlight()
+        buffer.listeners.append(highlight.changed)
+        history = History(buffer, lambda: (self.x, self.y))
+        buffer.listeners.append(self.scheduler.edited)
+        journal = Journal(self.writer)
+        buffer.listeners.append(journal.record)
+        document.state = {
+            'buffer': buffer, 'highlight': highlight, 'history': history,
+            'search': Search(buffer), 'journal': journal,
+            'selection': Selection(buffer),
+            'x': 0, 'y': 0, 'filename': filename, 'large_file': False,
+        }
+        self.documents.append(document)
+        self.recent.append(document)
+        return document
+
+    def switch_document(self, document):
+        if isinstance(document, int):
+            document = self.documents[document % len(self.documents)]
+        if not document.loaded and not self.readable(document.filename):
+            # Gone since it was opened, nothing to switch to.
+            self.documents.remove(document)
+            self.recent.remove(document)
+            return
+        self.document.store(self)
+        self.document = document
+        self.recent.remove(document)
+        self.recent.append(document)
+        document.restore(self)
+        self.selecting = False
+        self.selection.clear()
+        self.cursors = []
+        self.rows = None
+        self.show_message('[{}/{}] {}'.format(
+            self.documents.index(document)+1, len(self.documents),
+            document.name,
+        ))
+        if not document.loaded:
+            document.loaded = True
+            self.read_file(document.filename)
+        limit_caches(self.recent, self.cache_budget)
+        self.refresh()
 
-        self.add_history() # Make initial state a snapshot.
+    def cycle_document(self, direction=1):
+        self.switch_document(self.documents.index(self.document)+direction)
+
+    def open_file(self, filename):
+        # Switches to the file if it's already open.
+        if not filename:
+            return self.load_file()
+        path = os.path.abspath(filename)
+        for document in self.documents:
+            if document.filename and os.path.abspath(document.filename) == path:
+                return self.switch_document(document)
+        if self.readable(filename):
+            self.switch_document(self.add_document(filename))
+
+    def readable(self, filename):
+        try:
+            open(filename).close()
+        except OSError as error:
+            self.show_message('can\'t open {}: {}'.format(filename, error.strerror))
+            return False
+        return True
+
+    def close_document(self):
+        if len(self.documents) > 1:
+            document = self.document
+            document.state['journal'].close()
+            if self.watcher and document.filename:
+                self.watcher.unwatch(document.filename)
+            self.cycle_document(-1)
+            self.documents.remove(document)
+            self.recent.remove(document)
+
+    def close_journals(self):
+        # Quitting isn't a crash, there's nothing to recover next time.
+        for document in self.documents:
+            journal = document.state.get('journal')
+            if journal:
+                journal.close()
+
+    def new_file(self):
+        self.cursors = []
+        self.journal.close()
+        # The buffer no longer has anything to do with the file on disk.
+        if self.watcher and self.filename:
+            self.watcher.unwatch(self.filename)
+        self.document.disk = None
+        TextFileSelectionNode.new_file(self)
+        self.history.clear()
+
+    def read_file(self, filename):
+        TextFileSelectionNode.read_file(self, filename)
+        # Documents are looked up by filename, keep it current.
+        self.document.filename = filename
+        if not self.large_file:
+            self.document.disk = list(self.lines)
+        edits = self.journal.open(filename)
+        # Recovered edits aren't run until asked to, they may be what
+        # crashed it.
+        self.recovered = bool(edits)
+        if edits:
+            print('recovering {} edits from journal!'.format(len(edits)))
+            self.journal.replay(self.lines, edits)
+            self.scheduler.cancel()
+            self.show_message('recovered {} unsaved edits, not run yet'.format(
+                len(edits)
+            ))
+        self.history.clear()
+        if self.watcher and not self.large_file:
+            self.watcher.watch(filename)
+
+    def merge_changes(self):
+        for path in self.watcher.poll(busy=self.writer.busy()):
+            for document in self.documents:
+                filename = document.filename
+                if document.loaded and filename and os.path.abspath(filename) == path:
+                    self.merge_file(document)
+
+    def merge_file(self, document):
+        # Only splices in the lines that changed on disk, as one undo step,
+        # so the highlighting of everything else is kept. Unsaved edits are
+        # kept too, unless they touch the same lines.
+        if document is self.document:
+            document.store(self)
+        state = document.state
+        if state['large_file']:
+            return
+        filename, buffer = state['filename'], state['buffer']
+        with open(filename) as f:
+            lines = [line.strip('\n') for line in f] or ['']
+        if document.disk is None:
+            hunks = diff_lines(buffer, lines)
+        else:
+            hunks = merge_lines(document.disk, buffer, lines)
+        document.disk = lines
+        if hunks is None:
+            print('not merging changes to {}, they clash with unsaved edits!'.format(filename))
+            if document is self.document:
+                self.show_message('{} changed on disk, not merged'.format(document.name))
+            return
+        cursor = state['x'], state['y']
+        if hunks:
+            state['history'].commit(cursor)
+            for start, stop, new in hunks:
+                buffer.splice(start, stop, new)
+            state['history'].commit(cursor)
+            print('merged {} changes from {}!'.format(len(hunks), filename))
+        # The journal starts over from the new file, with the unsaved edits.
+        journal = state['journal']
+        journal.reset(filename)
+        for start, stop, new in diff_lines(lines, buffer):
+            journal.record(start, lines[start:stop], new)
+        if not hunks:
+            return
+        state['y'] = clamp(state['y'], 0, len(buffer)-1)
+        state['x'] = clamp(state['x'], 0, len(buffer[state['y']]))
+        if document is self.document:
+            self.x, self.y = state['x'], state['y']
+            self.cursors = []
+            self.refresh()
+            if self.scheduler.policy != 'manual':
+                self.scheduler.schedule(self.scheduler.delay)
 
+    def save_file(self, filename=None):
+        if filename:
+            self.filename = filename
+        print('saving as {}!'.format(self.filename))
+        self.document.filename = self.filename
+        if self.watcher:
+            self.watcher.watch(self.filename)
+        lines = self.lines.snapshot()
+        if not self.large_file:
+            self.document.disk = list(lines)
+        self.journal.save(self.filename, lines)
+        if self.watcher:
+            # So our own save isn't picked up as a change.
+            self.writer.put(self.watcher.touch, self.filename)
+
+    @timed('add_history')
     def add_history(self):
-        self.history.insert(0, ((self.x, self.y), self.lines[:]))
-        self.history = self.history[self.history_index:]
-        self.history_index = 0
+        self.history.commit((self.x, self.y))
 
     def undo_redo(self, direction=1):
-        self.history_index += direction
-        self.history_index = clamp(
-            self.history_index, 0, len(self.history)-1
-        )
-        history = self.history[self.history_index]
-        self.x, self.y = history[0]
-        self.lines = history[1][:]
+        self.cursors = []
+        self.add_history()
+        if direction > 0:
+            cursor = self.history.undo()
+        else:
+            cursor = self.history.redo()
+        if cursor:
+            self.x, self.y = cursor
         self.refresh()
 
     def copy(self):
-        self.paste_buffer = self.selection_buffer[:]
+        self.flush()
+        if self.selection:
+            self.paste_buffer = self.selection.text()
 
     def cut(self):
         self.copy()
+        if not self.selection:
+            return
         self.remove_range()
         self.add_history()
         self.refresh()
@@ -65,28 +306,27 @@ class TextEditorNode(TextFileSelectionNode):
     def paste(self):
         if len(self.paste_buffer) <= 0:
             return
-        if len(self.selection_buffer) > 0:
+        if self.cursors:
+            return self.edit_cursors(0, 0, '\n'.join(self.paste_buffer))
+        self.flush()
+        if self.selection:
             self.remove_range()
         to_paste = self.paste_buffer[:]
-        if self.x > 0:
-            a, b = split(self.line, self.x)
-            self.lines[self.y] = a + to_paste[-1]
-            to_paste = to_paste[:1]
-        for l, line in enumerate(to_paste):
-            self.lines.insert(self.y+1, line)
-        self.y += len(to_paste)
-
-        if self.x > 0:
-            self.lines[self.y] += b
-        self.scroll_max()
+        a, b = split(self.line, self.x)
+        to_paste[0] = a + to_paste[0]
+        self.x = len(to_paste[-1])
+        to_paste[-1] += b
+        self.lines.splice(self.y, self.y+1, to_paste)
+        self.y += len(to_paste)-1
         self.add_history()
         self.refresh()
 
+    @timed('draw_cursor')
     def draw_cursor(self):
-        new_card = self.draw_rect([self.x+self.line_number_width, self.y-self.line_offset, 0.0001, 0])
-        if self.cursor_card:
-            new_card.replace_node(self.cursor_card)
-        self.cursor_card = new_card
+        offset = self.line_offset
+        for x, y in [(self.x, self.y)] + self.cursors:
+            if offset <= y < offset+self.max_rows:
+                self.draw_rect([x+self.line_number_width, y-offset, 0.0001, 0])
 
     def move_char(self, amount, refresh=True):
         self.x += amount
@@ -121,20 +361,188 @@ class TextEditorNode(TextFileSelectionNode):
         if refresh:
             self.refresh()
 
-    def scroll(self, amount):
+    def scroll(self, amount, refresh=True):
         for i in range(self.max_rows-1):
             self.move_line(amount, refresh=False)
-        self.refresh()
+        if refresh:
+            self.refresh()
 
-    def scroll_max(self, line=True, end=True):
+    def scroll_max(self, line=True, end=True, refresh=True):
         if line:
             self.x = self.line_length if end else 0
         else:
-            self.y = len(self.lines) if end else 0
+            self.y = len(self.lines)-1 if end else 0
+        if refresh:
+            self.refresh()
+
+    def move_cursors(self, move, *args):
+        # Moves every cursor the same way, cursors that end up in the same
+        # place become one.
+        main = self.x, self.y
+        moved = []
+        for cursor in self.cursors:
+            self.x, self.y = cursor
+            move(*args, refresh=False)
+            moved.append([self.x, self.y])
+        self.x, self.y = main
+        move(*args)
+        self.cursors = []
+        for cursor in moved:
+            if cursor != [self.x, self.y] and cursor not in self.cursors:
+                self.cursors.append(cursor)
+
+    # Cursors
+    def add_cursor(self, x, y):
+        if [x, y] != [self.x, self.y] and [x, y] not in self.cursors:
+            self.cursors.append([x, y])
+        self.refresh()
+
+    def cursor_word(self):
+        # The word the main cursor is in or next to, as a pattern matching
+        # it as a whole word. The cursor is moved to its end.
+        for match in WORD.finditer(self.line):
+            if match.start() <= self.x <= match.end():
+                self.x = match.end()
+                return re.compile(r'\b{}\b'.format(re.escape(match.group())))
+
+    def occurrences(self, pattern, x, y):
+        # Ends of the matches after (x, y), wrapping around to the start.
+        for l in range(y, len(self.lines)):
+            for match in pattern.finditer(self.lines[l]):
+                if l > y or match.end() > x:
+                    yield [match.end(), l]
+        for l in range(0, y+1):
+            for match in pattern.finditer(self.lines[l]):
+                if l < y or match.end() <= x:
+                    yield [match.end(), l]
+
+    def add_cursor_next(self):
+        pattern = self.cursor_word()
+        if not pattern:
+            return
+        x, y = max([[self.x, self.y]] + self.cursors, key=lambda c: (c[1], c[0]))
+        for cursor in self.occurrences(pattern, x, y):
+            if cursor != [self.x, self.y] and cursor not in self.cursors:
+                self.add_cursor(*cursor)
+                break
+
+    def add_cursor_all(self):
+        pattern = self.cursor_word()
+        if not pattern:
+            return
+        self.cursors = []
+        for cursor in self.occurrences(pattern, self.x, self.y):
+            if cursor != [self.x, self.y]:
+                self.cursors.append(cursor)
+        self.show_message('{} cursors'.format(len(self.cursors)+1))
+        self.refresh()
+
+    def add_cursor_line(self, direction):
+        # Column selection: a cursor on the next line above or below.
+        cursors = [[self.x, self.y]] + self.cursors
+        x, y = max(cursors, key=lambda c: c[1]*direction)
+        y += direction
+        if 0 <= y < len(self.lines):
+            self.add_cursor(min(self.x, len(self.lines[y])), y)
+
+    def point_offset(self, x, y, amount):
+        # The (y, x) amount characters away, a line break counting as one.
+        while amount < 0:
+            if x >= -amount:
+                return y, x+amount
+            if y == 0:
+                return 0, 0
+            amount += x+1
+            y -= 1
+            x = len(self.lines[y])
+        while amount > 0:
+            length = len(self.lines[y])
+            if length-x >= amount:
+                return y, x+amount
+            if y == len(self.lines)-1:
+                return y, length
+            amount -= length-x+1
+            y += 1
+            x = 0
+        return y, x
+
+    @timed('edit_cursors')
+    def edit_cursors(self, before, after, text):
+        # One keystroke at every cursor, as one edit: the characters before
+        # and after each cursor are replaced by text. Edits are spliced in
+        # bottom up so the positions above stay valid, then every cursor is
+        # moved past its text in one pass top down. One undo step, one
+        # refresh, however many cursors.
+        self.flush()
+        self.selection.clear()
+        main = self.y, self.x
+        edits = []
+        for y, x in sorted(set([(y, x) for x, y in self.cursors] + [main])):
+            start = self.point_offset(x, y, -before)
+            end = self.point_offset(x, y, after)
+            primary = (y, x) == main
+            if edits and start < edits[-1][1]:
+                # Overlaps the previous edit, the cursors merge.
+                if primary:
+                    edits[-1][2] = True
+                continue
+            edits.append([start, end, primary])
+        # Edits that touch the same lines are spliced in together.
+        groups = []
+        for edit in edits:
+            if groups and edit[0][0] <= groups[-1][-1][1][0]:
+                groups[-1].append(edit)
+            else:
+                groups.append([edit])
+        for group in reversed(groups):
+            first, last = group[0][0][0], group[-1][1][0]
+            old = self.lines[first:last+1]
+            starts = [0]
+            for line in old:
+                starts.append(starts[-1]+len(line)+1)
+            old = '\n'.join(old)
+            pieces = []
+            position = 0
+            for (ay, ax), (by, bx), primary in group:
+                pieces.append(old[position:starts[ay-first]+ax])
+                pieces.append(text)
+                position = starts[by-first]+bx
+            pieces.append(old[position:])
+            self.lines.splice(first, last+1, ''.join(pieces).split('\n'))
+        new = text.split('\n')
+        ends = []
+        shift = 0
+        last = None # old end and new end of the previous edit
+        for (ay, ax), (by, bx), primary in edits:
+            if last and last[0][0] == ay:
+                y, x = last[1][0], last[1][1] + ax-last[0][1]
+            else:
+                y, x = ay+shift, ax
+            if len(new) == 1:
+                end = y, x+len(new[0])
+            else:
+                end = y+len(new)-1, len(new[-1])
+            shift += len(new)-1 - (by-ay)
+            last = (by, bx), end
+            if primary:
+                self.y, self.x = end
+            else:
+                ends.append([end[1], end[0]])
+        # Cursors that end up in the same place become one.
+        self.cursors = []
+        for cursor in ends:
+            if cursor != [self.x, self.y] and cursor not in self.cursors:
+                self.cursors.append(cursor)
+        self.add_history()
         self.refresh()
 
     def remove(self, backwards=True, refresh=True):
-        if len(self.selection_buffer) > 0:
+        if self.cursors:
+            if backwards:
+                return self.edit_cursors(1, 0, '')
+            return self.edit_cursors(0, 1, '')
+        self.flush()
+        if self.selection:
             self.remove_range()
             self.add_history()
             self.refresh()
@@ -144,12 +552,11 @@ class TextEditorNode(TextFileSelectionNode):
             self.move_char(1)
         a, b = split(self.line, self.x)
         if len(a) == 0:
-            if len(self.lines)-1 == 0:
+            if self.y == 0:
                 return
-            self.lines.pop(self.y)
             self.y -= 1
             self.x = self.line_length
-            self.lines[self.y] += b
+            self.lines.splice(self.y, self.y+2, [self.line + b])
         else:
             a = a[:-1]
             self.x -= 1
@@ -159,7 +566,9 @@ class TextEditorNode(TextFileSelectionNode):
             self.refresh()
 
     def add(self, keyname):
-        if keyname in LEGAL_CHARACTERS:
+        if keyname in LEGAL_CHARACTERS and self.cursors:
+            self.edit_cursors(0, 0, keyname)
+        elif keyname in LEGAL_CHARACTERS:
             a,b = split(self.line, self.x)
             self.lines[self.y] = a+keyname+b
             self.x += 1
@@ -167,15 +576,17 @@ class TextEditorNode(TextFileSelectionNode):
             self.refresh()
 
     def enter(self):
+        if self.cursors:
+            self.edit_cursors(0, 0, '\n')
+            self.scheduler.entered()
+            return
         string_a, string_b = split(self.line, self.x)
-        self.lines.pop(self.y)
-        lines_a, lines_b = split(self.lines, self.y)
-        self.lines = lines_a + [string_a] + [string_b] + lines_b
+        self.lines.splice(self.y, self.y+1, [string_a, string_b])
         self.x = 0
         self.y += 1
         self.add_history()
         self.refresh()
-        self.run()
+        self.scheduler.entered()
 
     def tab(self, backwards=False):
         if backwards:
@@ -188,6 +599,8 @@ class TextEditorNode(TextFileSelectionNode):
                 self.x -= self.tab_size
                 self.add_history()
                 self.refresh()
+        elif self.cursors:
+            self.edit_cursors(0, 0, ' '*self.tab_size)
         else:
             for i in range(self.tab_size):
                 self.add(" ")
@@ -203,32 +616,36 @@ class TextEditorNode(TextFileSelectionNode):
         base.buttonThrowers[0].node().setKeystrokeEvent('keystroke')
         self.key('keystroke', self.add)
         self.key('enter', self.enter)
-        self.key('shift-enter', self.run)
+        self.key('shift-enter', self.run, [True])
 
-        self.key('arrow_left', self.move_char, [-1])
-        self.key('arrow_right', self.move_char, [1])
-        self.key('arrow_up', self.move_line, [-1])
-        self.key('arrow_down', self.move_line, [1])
-        self.key("control-arrow_left", self.move_word, [-1])
-        self.key("control-arrow_right", self.move_word, [1])
+        self.key('arrow_left', self.move_cursors, [self.move_char, -1])
+        self.key('arrow_right', self.move_cursors, [self.move_char, 1])
+        self.key('arrow_up', self.move_cursors, [self.move_line, -1])
+        self.key('arrow_down', self.move_cursors, [self.move_line, 1])
+        self.key("control-arrow_left", self.move_cursors, [self.move_word, -1])
+        self.key("control-arrow_right", self.move_cursors, [self.move_word, 1])
 
         self.key('tab', self.tab)
         self.key('shift-tab', self.tab, extra_args=[True])
         self.key('control-tab', self.hide)
+        self.key('control-t', self.hud.toggle)
 
         self.key('backspace', self.remove)
         self.key('delete', self.remove, extra_args=[False])
 
-        self.key('end', self.scroll_max, extra_args=[True, True])
-        self.key('home', self.scroll_max, extra_args=[True, False])
-        self.key('control-end', self.scroll_max, extra_args=[False, True])
-        self.key('control-home', self.scroll_max, extra_args=[False, False])
-        self.key('page_down', self.scroll, extra_args=[1])
-        self.key('page_up', self.scroll, extra_args=[-1])
+        self.key('end', self.move_cursors, [self.scroll_max, True, True])
+        self.key('home', self.move_cursors, [self.scroll_max, True, False])
+        self.key('control-end', self.move_cursors, [self.scroll_max, False, True])
+        self.key('control-home', self.move_cursors, [self.scroll_max, False, False])
+        self.key('page_down', self.move_cursors, [self.scroll, 1])
+        self.key('page_up', self.move_cursors, [self.scroll, -1])
 
         self.key('control-n', self.new_file)
         self.key('control-s', self.save_file)
-        self.key('control-o', self.load_file)
+        self.key('control-o', self.prompt, extra_args=['open: ', self.open_file])
+        self.key('control-w', self.close_document)
+        self.key('control-page_down', self.cycle_document, extra_args=[1])
+        self.key('control-page_up', self.cycle_document, extra_args=[-1])
 
         self.key('control-c', self.copy)
         self.key('control-x', self.cut)
@@ -237,15 +654,204 @@ class TextEditorNode(TextFileSelectionNode):
         self.key('control-z', self.undo_redo, extra_args=[1])
         self.key('control-y', self.undo_redo, extra_args=[-1])
 
+        self.key('control-f', self.find)
+        self.key('control-r', self.find, extra_args=[True])
+        self.key('control-g', self.find_next, extra_args=[1])
+        self.accept('shift-control-g', self.find_next, extraArgs=[-1])
+        self.key('control-h', self.replace)
+        self.key('escape', self.clear_search)
+
+        self.key('control-d', self.add_cursor_next)
+        self.accept('shift-control-d', self.add_cursor_all)
+        self.key('control-alt-arrow_down', self.add_cursor_line, [1])
+        self.key('control-alt-arrow_up', self.add_cursor_line, [-1])
+
+    # Prompt
+    def prompt(self, label, callback, changed=None):
+        # Takes over the keyboard to ask for a line of text.
+        self.ignore_all()
+        self.prompting = [label, '', callback, changed]
+        self.accept('keystroke', self.prompt_add)
+        self.accept('backspace', self.prompt_remove)
+        self.accept('backspace-repeat', self.prompt_remove)
+        self.accept('enter', self.end_prompt, extraArgs=[True])
+        self.accept('escape', self.end_prompt, extraArgs=[False])
+        self.show_message(label+'_')
+
+    def prompt_add(self, keyname):
+        if keyname in LEGAL_CHARACTERS:
+            self.prompting[1] += keyname
+            self.prompt_changed()
+
+    def prompt_remove(self):
+        self.prompting[1] = self.prompting[1][:-1]
+        self.prompt_changed()
+
+    def prompt_changed(self):
+        label, text, callback, changed = self.prompting
+        self.show_message(label+text+'_')
+        if changed:
+            changed(text)
+
+    def end_prompt(self, confirm):
+        label, text, callback, changed = self.prompting
+        self.prompting = None
+        self.ignore_all()
+        self.setup_select_input()
+        self.setup_input()
+        self.show_message('')
+        if confirm:
+            callback(text)
+
+    def show_message(self, message):
+        if self.status.get_text() != message:
+            self.status.set_text(message)
+
+    # Search
+    def find(self, regex=False):
+        origin = self.x, self.y
+        def changed(query):
+            try:
+                self.search.set_pattern(query, regex)
+            except re.error:
+                return
+            self.x, self.y = origin
+            self.find_next(1, origin[0]-1)
+        label = 'find regex: ' if regex else 'find: '
+        self.prompt(label, lambda query: None, changed)
+
+    def find_next(self, direction=1, x=None):
+        x = self.x if x is None else x
+        match = self.search.find(x, self.y, direction)
+        if match:
+            self.y, self.x = match[0], match[1]
+        elif self.search.pattern:
+            self.show_message('no matches')
+        self.refresh()
+
+    def replace(self):
+        if not self.search.pattern:
+            self.show_message('find something to replace first')
+            return
+        self.prompt('replace with: ', self.replace_all)
+
+    def replace_all(self, replacement):
+        try:
+            replaced = self.search.replace_all(replacement)
+        except re.error as error:
+            self.show_message('bad replacement: {}'.format(error))
+            return
+        if not replaced:
+            self.show_message('no matches')
+            return
+        first, lines = replaced
+        self.lines.splice(first, first+len(lines), lines)
+        self.x = min(self.x, self.line_length)
+        self.add_history()
+        self.refresh()
+
+    def clear_search(self):
+        self.cursors = []
+        self.search.set_pattern('')
+        self.show_message('')
+        self.refresh()
+
+    def draw_matches(self):
+        if not self.search.pattern:
+            return
+        start = self.line_offset
+        for l in range(start, min(start+self.max_rows, len(self.lines))):
+            for a, b in self.search.matches(l):
+                rect = [self.line_number_width+a, l-start, b-a-1, 0]
+                self.draw_rect(rect, MATCH_COLOR)
+
+    def toggle_select(self, on=True):
+        self.flush()
+        TextFileSelectionNode.toggle_select(self, on)
+
     def refresh(self):
+        self.dirty = True
+
+    def flush(self):
+        # Redraw now if needed, for things that rely on the selection.
+        if self.dirty:
+            self.redraw()
+
+    def update(self, task):
+        if self.lines.sync():
+            self.refresh()
+        if self.highlight.plain and self.highlight.ready:
+            self.highlight.plain = False
+            self.refresh()
+        self.journal.update()
+        if self.watcher:
+            self.merge_changes()
+        self.flush()
+        return task.cont
+
+    @timed('redraw')
+    def redraw(self):
+        self.dirty = False
         if self.selecting:
             self.select_range()
         else:
             self.clear_rects()
-            self.selection_buffer = []
+            self.selection.clear()
+        self.draw_matches()
         self.draw_cursor()
+        self.overlay.commit()
         self.write_out()
-        self.text = self.highlight.highlight(self.text)
 
-    def run(self):
-        self.repl.repl(self.lines)
+    def format_line_number(self, l):
+        return self.highlight.highlight_number(
+            TextFileSelectionNode.format_line_number(self, l)
+        )
+
+    def format_lines(self, start, end):
+        if self.large_file:
+            return TextFileSelectionNode.format_lines(self, start, end)
+        return self.highlight.highlight_lines(self.lines, start, end)
+
+    def draw_rows(self, rows):
+        # Numbers and code are separate tiles, so inserting a line only
+        # moves the code tiles under it.
+        code_x = self.line_number_width*self.rect_w
+        cells = []
+        for row, (number, line) in enumerate(rows):
+            if number:
+                cells.append((number, 0, row))
+            if line:
+                cells.append((line, code_x, row))
+        self.tiles.draw(cells)
+
+    def apply_patch(self, start, stop, lines):
+        # Replaces lines start:stop as one undo step. Checked before the
+        # buffer is touched, lines may come from anywhere.
+        if not isinstance(start, int) or not isinstance(stop, int):
+            raise TypeError('patch start and stop must be ints')
+        if not 0 <= start <= stop <= len(self.lines):
+            raise IndexError('patch out of range')
+        if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+            raise TypeError('patch lines must be a list of strings')
+        lines = [part for line in lines for part in line.split('\n')]
+        if not lines and stop-start == len(self.lines):
+            lines = ['']
+        self.add_history()
+        self.lines.splice(start, stop, lines)
+        self.add_history()
+        self.cursors = []
+        self.y = clamp(self.y, 0, len(self.lines)-1)
+        self.x = clamp(self.x, 0, len(self.line))
+        self.refresh()
+
+    def run_loaded(self):
+        if self.recovered:
+            return
+        if self.run_delay is None:
+            self.run()
+        else:
+            self.scheduler.schedule(self.run_delay)
+
+    def run(self, full=False):
+        self.scheduler.cancel()
+        self.repl.repl(self.lines, full)
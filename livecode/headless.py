@@ -0,0 +1,30 @@
+import os
+from panda3d.core import load_prc_file_data
+from panda3d.core import NodePath, Camera, ButtonThrower, MouseWatcher
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_headless_base(window_type='none'):
+    # A ShowBase without a window (or with an offscreen buffer) that still
+    # has what the editor and live code expect: a camera, a button thrower
+    # for key events and a mouse watcher.
+    from direct.showbase.ShowBase import ShowBase
+    load_prc_file_data('', '\n'.join([
+        'window-type {}'.format(window_type),
+        'audio-library-name null',
+        'model-path {}'.format(ROOT),
+    ]))
+    base = ShowBase()
+    fill_headless(base)
+    return base
+
+def fill_headless(base):
+    if base.camera is None:
+        base.camera = base.render.attach_new_node('camera')
+        base.cam = base.camera.attach_new_node(Camera('cam'))
+    if base.mouseWatcherNode is None:
+        base.mouseWatcherNode = MouseWatcher('mouse watcher')
+    if not base.buttonThrowers:
+        base.buttonThrowers = [NodePath(ButtonThrower('button thrower'))]
@@ -1,23 +1,97 @@
-from pygments import highlight
-from pygments.styles import STYLE_MAP
-from pygments.formatter import Formatter
-from pygments.lexers import PythonLexer
+import os
+import re
+import json
+from io import StringIO
+from threading import Thread
 from panda3d.core import TextPropertiesManager, TextProperties
+from .profile import timed
 
 
-class TextNodeFormatter(Formatter):
-    def __init__(self, **options):
-        Formatter.__init__(self, **options)
-        self.styles = {}
+NUMBER = 'Token.Literal.Number'
+STYLES = {} # name: token colors
+# Lines inside a docstring end their state with DOCSTRING.
+DOCSTRING = 'docstring'
+DOCSTRING_START = re.compile(r'\s*[rRuUbB]{,2}("""|\'\'\')')
+
+
+def cache_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'panda3d-livecode')
+
+def load_style(name):
+    # Token colors of a Pygments style as {token name: (r, g, b, a)}. Reading
+    # the style means importing Pygments' style registry, which is slow, so
+    # the table is kept on disk after the first time.
+    if name in STYLES:
+        return STYLES[name]
+    import pygments
+    path = os.path.join(
+        cache_directory(), 'style-{}-{}.json'.format(name, pygments.__version__)
+    )
+    try:
+        with open(path) as f:
+            STYLES[name] = {
+                token: tuple(color) if color else None
+                for token, color in json.load(f).items()
+            }
+        return STYLES[name]
+    except (OSError, ValueError):
+        pass
+    from pygments.styles import get_style_by_name
+    n = 1/255
+    table = {}
+    for token, style in get_style_by_name(name):
+        color = None
+        if style['color']:
+            # hex color (#FF0000) to vec4 (1,0,0,1)
+            color = tuple(n*int(style['color'][i:i+2], 16) for i in (0, 2, 4))
+            color = color + (1,)
+        table[str(token)] = color
+    try:
+        os.makedirs(cache_directory(), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(table, f)
+    except OSError as error:
+        print('could not cache style: {}'.format(error))
+    STYLES[name] = table
+    return table
+
+
+class LexerLoader():
+    # Pygments' lexers are slow to import, so the lexer is loaded on a thread
+    # the first time something is highlighted. Lines are shown plain until
+    # it's ready. The lexer is shared, lex_line keeps no state in it.
+    def __init__(self):
+        self.lexer = None
+        self.thread = None
+
+    def get(self):
+        if self.lexer is None and self.thread is None:
+            self.thread = Thread(target=self.load, name='livecode lexer')
+            self.thread.daemon = True
+            self.thread.start()
+        return self.lexer
+
+    def load(self):
+        from pygments.lexers.python import PythonLexer
+        self.lexer = PythonLexer()
+
+    def wait(self):
+        self.get()
+        self.thread.join()
+        return self.lexer
+
+
+LEXER = LexerLoader()
+
+
+class TextNodeFormatter():
+    def __init__(self, style='default'):
+        self.table = {}
         manager = TextPropertiesManager.getGlobalPtr()
-        n = 1/255
-        for token, style in self.style:
+        for token, color in load_style(style).items():
             start = end = ''
-            if style['color']:
-                # hex color (#FF0000) to RGB 255 (255,0,0)
-                color = tuple(int(style['color'][i:i+2], 16) for i in (0, 2, 4))
-                # RGB 255 to vec4 (1,0,0,1), obsolete step?
-                color = (n*color[0],n*color[1],n*color[2],1)
+            if color:
                 tp = TextProperties()
                 tp.setTextColor(color)
                 manager.setProperties(str(color), tp)
@@ -25,32 +99,206 @@ class TextNodeFormatter(Formatter):
                 start += '\1%s\1' % str(color)
                 # \2 resets TextProperties
                 end = str('\2' + end)
-            self.styles[token] = (start, end)
+            self.table[token] = (start, end)
+        # Token type: (start, end), filled in as tokens are seen.
+        self.styles = {}
+
+    def style(self, ttype):
+        style = self.styles.get(ttype)
+        if style is None:
+            # Token types inherit the style of their parent.
+            name = str(ttype)
+            while name not in self.table and '.' in name:
+                name = name.rpartition('.')[0]
+            style = self.styles[ttype] = self.table.get(name, ('', ''))
+        return style
 
     def format(self, tokensource, outfile):
         lastval = ''
         lasttype = None
         for ttype, value in tokensource:
-            while ttype not in self.styles:
-                ttype = ttype.parent
             if ttype == lasttype:
                 lastval += value
             else:
                 if lastval:
-                    stylebegin, styleend = self.styles[lasttype]
+                    stylebegin, styleend = self.style(lasttype)
                     outfile.write(stylebegin + lastval + styleend)
                 lastval = value
                 lasttype = ttype
         if lastval:
-            stylebegin, styleend = self.styles[lasttype]
+            stylebegin, styleend = self.style(lasttype)
             outfile.write(stylebegin + lastval + styleend)
 
+    def format_string(self, tokens):
+        outfile = StringIO()
+        self.format(tokens, outfile)
+        return outfile.getvalue()
+
 
 class Highlight():
     def __init__(self):
-        self.styles = STYLE_MAP.keys()
         self.formatter = TextNodeFormatter(style="paraiso-dark")
-        self.lexer = PythonLexer()
+        self.cache_size = 20000
+        self.clear()
+
+    def clear(self):
+        # (start state, line) -> (formatted line, end state)
+        self.cache = {}
+        self.cache_bytes = 0
+        # Per line position: source line and (start state, formatted line,
+        # end state). Lines before self.valid are known to be up to date.
+        self.lines = []
+        self.line_states = []
+        self.valid = 0
+        # Set when lines were returned plain because the lexer wasn't ready.
+        self.plain = False
+
+    @property
+    def ready(self):
+        return LEXER.lexer is not None
+
+    def highlight_number(self, string):
+        return self.formatter.format_string([(NUMBER, string)])
+
+    def changed(self, start, old, new):
+        # Listener for LineBuffer edits, keeps the per line cache aligned.
+        if start < len(self.lines):
+            stop = start + len(old)
+            self.lines[start:stop] = [None]*len(new)
+            self.line_states[start:stop] = [None]*len(new)
+        self.valid = min(self.valid, start)
+
+    @timed('highlight')
+    def highlight_lines(self, lines, start, end):
+        # Lines are lexed one at a time and cached on their starting state,
+        # so an edit only re-lexes from the changed line until the state
+        # it ends in matches what was cached before (a closed string etc.).
+        end = min(end, len(lines))
+        if LEXER.get() is None:
+            self.plain = True
+            return lines[start:end]
+        l = self.valid = min(self.valid, len(self.lines))
+        state = self.line_states[l-1][2] if l > 0 else ('root',)
+        for l, line in enumerate(lines[l:end], l):
+            if l < len(self.lines):
+                cached = self.line_states[l]
+                if self.lines[l] is line and cached[0] == state:
+                    state = cached[2]
+                    continue
+            formatted, next_state = self.lex_cached(line, state)
+            if l < len(self.lines):
+                self.lines[l] = line
+                self.line_states[l] = (state, formatted, next_state)
+            else:
+                self.lines.append(line)
+                self.line_states.append((state, formatted, next_state))
+            state = next_state
+        self.valid = max(self.valid, end)
+        return [cached[1] for cached in self.line_states[start:end]]
+
+    def lex_cached(self, line, state):
+        key = (state, line)
+        cached = self.cache.get(key)
+        if cached is None:
+            if len(self.cache) > self.cache_size:
+                self.cache.clear()
+                self.cache_bytes = 0
+            tokens, next_state = self.lex_line(line, state)
+            cached = self.formatter.format_string(tokens), next_state
+            self.cache[key] = cached
+            self.cache_bytes += 2*len(line) + len(cached[0]) + 200
+        return cached
+
+    def lex_line(self, line, state):
+        # Mirrors RegexLexer.get_tokens_unprocessed, but for a single line
+        # and returning the state stack it ends in. PythonLexer only sees a
+        # docstring when it's lexed whole, so the string tokens of one that
+        # spans lines are turned into String.Doc here.
+        from pygments.token import Error, Whitespace, String, _TokenType
+        lexer = LEXER.lexer
+        text = line + '\n'
+        tokens = []
+        pos = 0
+        tokendefs = lexer._tokens
+        statestack = list(state)
+        doc_depth = doc_end = None
+        if statestack[-1] == DOCSTRING:
+            statestack.pop()
+            doc_depth = len(statestack)
+        statetokens = tokendefs[statestack[-1]]
+        while True:
+            for rexmatch, action, new_state in statetokens:
+                m = rexmatch(text, pos)
+                if m:
+                    if action is not None:
+                        if type(action) is _TokenType:
+                            tokens.append((action, m.group()))
+                        else:
+                            for _, ttype, value in action(lexer, m):
+                                tokens.append((ttype, value))
+                    pos = m.end()
+                    if new_state is not None:
+                        if isinstance(new_state, tuple):
+                            for s in new_state:
+                                if s == '#pop':
+                                    if len(statestack) > 1:
+                                        statestack.pop()
+                                elif s == '#push':
+                                    statestack.append(statestack[-1])
+                                else:
+                                    statestack.append(s)
+                        elif isinstance(new_state, int):
+                            if abs(new_state) >= len(statestack):
+                                del statestack[1:]
+                            else:
+                                del statestack[new_state:]
+                        elif new_state == '#push':
+                            statestack.append(statestack[-1])
+                        statetokens = tokendefs[statestack[-1]]
+                        if doc_depth and doc_end is None and len(statestack) < doc_depth:
+                            doc_end = len(tokens)
+                    break
+            else:
+                if pos >= len(text):
+                    break
+                if text[pos] == '\n':
+                    statestack = ['root']
+                    statetokens = tokendefs['root']
+                    tokens.append((Whitespace, '\n'))
+                else:
+                    tokens.append((Error, text[pos]))
+                pos += 1
+        # Drop the newline that was added for the lexer.
+        while tokens:
+            ttype, value = tokens.pop()
+            if value.endswith('\n'):
+                value = value[:-1]
+            if value:
+                tokens.append((ttype, value))
+                break
+        if doc_depth:
+            # Inside a docstring up to where its string state was left.
+            end = len(tokens) if doc_end is None else doc_end
+            tokens[:end] = [(String.Doc, value) for ttype, value in tokens[:end]]
+            if doc_end is None:
+                statestack.append(DOCSTRING)
+        elif state == ('root',) and len(statestack) > 1:
+            # A docstring that isn't closed on the line it starts on. Unlike
+            # Pygments, that's a docstring before the closing quotes are in.
+            match = DOCSTRING_START.match(line)
+            if match:
+                tokens = self.doc_tokens(tokens, match.start(1), String.Doc, Whitespace)
+                statestack.append(DOCSTRING)
+        return tokens, tuple(statestack)
 
-    def highlight(self, code):
-        return highlight(code, self.lexer, self.formatter)
+    def doc_tokens(self, tokens, start, doc, space):
+        # The tokens from character start on become doc, the indentation
+        # before it space.
+        offset = 0
+        for i, (ttype, value) in enumerate(tokens):
+            if offset >= start:
+                tokens[i] = (doc, value)
+            elif value.isspace():
+                tokens[i] = (space, value)
+            offset += len(value)
+        return tokens
@@ -0,0 +1,104 @@
+class History():
+    # Undo steps only keep the edits made to the LineBuffer, as
+    # (start, old_lines, new_lines), and undo them by splicing back.
+    def __init__(self, lines, cursor, max_steps=1000, max_bytes=16*1024*1024):
+        self.lines = lines
+        self.cursor = cursor
+        self.lines.listeners.append(self.record)
+        self.max_steps = max_steps
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self.steps = [] # Oldest first: [before, after, edits, size]
+        self.index = 0 # Amount of steps undone.
+        self.size = 0
+        self.pending = []
+        self.before = None
+        self.applying = False
+
+    def record(self, start, old, new):
+        if self.applying:
+            return
+        if not self.pending:
+            self.before = self.cursor()
+        self.pending.append((start, old, new))
+
+    def commit(self, after):
+        if not self.pending:
+            return
+        edits, self.pending = self.pending, []
+        if self.index:
+            for step in self.steps[-self.index:]:
+                self.size -= step[3]
+            del self.steps[-self.index:]
+            self.index = 0
+        if self.merge(edits, after):
+            return
+        size = edit_size(edits)
+        self.steps.append([self.before, after, edits, size])
+        self.size += size
+        while len(self.steps) > 1 and (
+            len(self.steps) > self.max_steps or self.size > self.max_bytes
+        ):
+            self.size -= self.steps.pop(0)[3]
+
+    def merge(self, edits, after):
+        # Consecutive characters typed on one line become one step,
+        # broken up on word boundaries.
+        if not self.steps or len(edits) != 1:
+            return False
+        step = self.steps[-1]
+        if step[1] != self.before or len(step[2]) != 1:
+            return False
+        start, old, new = edits[0]
+        last_start, last_old, last_new = step[2][0]
+        if not (start == last_start and is_typed(old, new, 1)
+                and is_typed(last_old, last_new) and old[0] == last_new[0]):
+            return False
+        x = self.before[0]
+        if new[0][x:x+1].isspace() and not new[0][x-1:x].isspace():
+            return False
+        step[1] = after
+        step[2] = [(start, last_old, new)]
+        self.size -= step[3]
+        step[3] = edit_size(step[2])
+        self.size += step[3]
+        return True
+
+    def undo(self):
+        if self.index >= len(self.steps):
+            return None
+        self.index += 1
+        before, after, edits, size = self.steps[-self.index]
+        self.apply([(s, new, old) for s, old, new in reversed(edits)])
+        return before
+
+    def redo(self):
+        if self.index <= 0:
+            return None
+        before, after, edits, size = self.steps[-self.index]
+        self.index -= 1
+        self.apply(edits)
+        return after
+
+    def apply(self, edits):
+        self.applying = True
+        try:
+            for start, old, new in edits:
+                self.lines.splice(start, start+len(old), new)
+        finally:
+            self.applying = False
+
+
+def edit_size(edits):
+    return sum(
+        64 + sum(len(line) for line in old) + sum(len(line) for line in new)
+        for start, old, new in edits
+    )
+
+def is_typed(old, new, amount=None):
+    if not len(old) == len(new) == 1:
+        return False
+    typed = len(new[0]) - len(old[0])
+    return typed == amount if amount else typed > 0
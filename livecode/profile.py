@@ -0,0 +1,86 @@
+import time
+import functools
+from collections import deque
+from panda3d.core import PStatCollector, TextNode
+
+
+class Timers():
+    # Time spent per named phase. Every phase has a PStatCollector, so it
+    # shows up in pstats, and is also timed in-process while enabled
+    # (for the timing hud).
+    def __init__(self, window=120):
+        self.enabled = False
+        self.window = window
+        self.frame = {} # name: seconds spent this frame
+        self.frames = {} # name: seconds per frame, for the last frames
+
+    def add(self, name, seconds):
+        self.frame[name] = self.frame.get(name, 0) + seconds
+
+    def end_frame(self):
+        for name in self.frames.keys() | self.frame.keys():
+            if name not in self.frames:
+                self.frames[name] = deque(maxlen=self.window)
+            self.frames[name].append(self.frame.get(name, 0))
+        self.frame = {}
+
+    def clear(self):
+        self.frame = {}
+        self.frames = {}
+
+
+timers = Timers()
+
+
+def timed(name):
+    collector = PStatCollector('Livecode:'+name)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            collector.start()
+            start = time.perf_counter() if timers.enabled else None
+            try:
+                return function(*args, **kwargs)
+            finally:
+                collector.stop()
+                if start is not None:
+                    timers.add(name, time.perf_counter()-start)
+        return wrapper
+    return decorator
+
+
+class TimingHud():
+    # Per frame cost and rolling max of each timed phase, in the top
+    # right corner.
+    def __init__(self):
+        self.node = TextNode('timing hud')
+        self.node.set_align(TextNode.A_right)
+        self.node.set_text_color((1,1,0.5,1))
+        self.node.set_shadow(0.08)
+        self.node.set_shadow_color((0,0,0,1))
+        self.node_path = base.aspect2d.attach_new_node(self.node)
+        self.node_path.set_scale(0.04)
+        self.node_path.set_pos((base.get_aspect_ratio()-0.05, 0, 0.9))
+        self.node_path.hide()
+        # After rendering, so the frame's redraw is counted.
+        base.task_mgr.add(self.update, 'timing hud', sort=51)
+
+    def toggle(self):
+        timers.enabled = not timers.enabled
+        timers.clear()
+        if timers.enabled:
+            self.node_path.show()
+        else:
+            self.node_path.hide()
+
+    def update(self, task):
+        if timers.enabled:
+            timers.end_frame()
+            rows = ['{:<14}{:>8}{:>8}'.format('ms', 'frame', 'max')]
+            for name in sorted(timers.frames):
+                frames = timers.frames[name]
+                rows.append('{:<14}{:>8.2f}{:>8.2f}'.format(
+                    name, frames[-1]*1000, max(frames)*1000
+                ))
+            self.node.set_text('\n'.join(rows))
+        return task.cont
@@ -1,28 +1,242 @@
+import ast
 import builtins
+import hashlib
+import linecache
+import traceback
+from io import StringIO
+from contextlib import redirect_stdout
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from panda3d.core import NodePath
+from .assets import AssetCache
+from .profile import timed
+from .tasks import TaskProfiler
+
+
+FILENAME = '<livecode>'
+SNIPPET = '<snippet>'
+DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+# Class attributes that are never copied over when patching a class.
+SKIP_ATTRIBUTES = (
+    '__dict__', '__weakref__', '__module__', '__qualname__', '__doc__',
+)
+
+
+class Compiled():
+    # Everything a run needs from the source, made on the compile thread.
+    def __init__(self, source):
+        self.source = source
+        self.module = ast.parse(source, FILENAME)
+        self.code = compile(self.module, FILENAME, 'exec')
+        # Top-level definitions by name, and a dump of everything else.
+        self.definitions = {}
+        self.codes = {}
+        self.statements = []
+        for node in self.module.body:
+            if isinstance(node, DEFINITIONS):
+                self.definitions[node.name] = ast.dump(node)
+                single = ast.Module(body=[node], type_ignores=[])
+                self.codes[node.name] = compile(single, FILENAME, 'exec')
+            else:
+                self.statements.append(ast.dump(node))
 
 
-# TODO: This is dumb atm.
 class Repl():
-    def __init__(self):
+    def __init__(self, hot_reload=True):
+        # Code is compiled on a worker thread, finished compiles are picked
+        # up by this task and run on the main thread.
+        self.compiler = ThreadPoolExecutor(1, 'livecode compile')
+        self.compiled = OrderedDict() # source hash: Compiled
+        self.cache_size = 16
+        self.pending = None
+        base.task_mgr.add(self.poll, 'livecode compile poll')
+
         self.base_tasks = []
         for task in base.task_mgr.getTasks():
             self.base_tasks.append(task)
+        # With hot_reload, runs that only change top-level functions and
+        # classes patch them into the running code instead of restarting.
+        self.hot_reload = hot_reload
+        # Survives reloads, offered to the live code as `assets`.
+        self.assets = AssetCache()
+        # Times the tasks the live code adds, pausing ones that hog frames.
+        self.tasks = TaskProfiler()
+        self.namespace = None
+        self.definitions = {}
+        self.statements = None
+        # What went wrong in the last run, None if it went fine.
+        self.last_error = None
 
     def reset_showbase(self):
+        old_render = base.render
         base.render = NodePath("new render!")
         for task in base.task_mgr.getTasks():
             if not task in self.base_tasks:
                 task.remove()
         base.camera.reparent_to(base.render)
         builtins.render = base.render
+        old_render.remove_node()
+        self.tasks.clear()
+
+    @timed('repl')
+    def repl(self, code, full=False):
+        source = '\n'.join(code)
+        key = hashlib.sha1(source.encode()).hexdigest()
+        if self.pending:
+            # A newer run replaces one that is still compiling.
+            future, pending_key, pending_full = self.pending
+            future.cancel()
+            full = full or pending_full
+            self.pending = None
+        if key in self.compiled:
+            self.compiled.move_to_end(key)
+            self.run(self.compiled[key], full)
+        else:
+            future = self.compiler.submit(Compiled, source)
+            self.pending = future, key, full
+
+    def poll(self, task):
+        self.tasks.scan(self.base_tasks)
+        if self.pending and self.pending[0].done():
+            future, key, full = self.pending
+            self.pending = None
+            try:
+                compiled = future.result()
+            except SyntaxError as error:
+                self.last_error = error
+                report_error(error)
+            else:
+                self.compiled[key] = compiled
+                while len(self.compiled) > self.cache_size:
+                    self.compiled.popitem(last=False)
+                self.run(compiled, full)
+        return task.cont
+
+    @timed('repl run')
+    def run(self, compiled, full=False):
+        # So tracebacks can show the offending lines.
+        lines = compiled.source.splitlines(True)
+        linecache.cache[FILENAME] = (len(compiled.source), None, lines, FILENAME)
+        self.last_error = None
+        try:
+            hot = self.hot_reload and not full and self.namespace is not None
+            if hot and compiled.statements == self.statements:
+                self.patch(compiled)
+                self.tasks.resume()
+            else:
+                self.reload(compiled)
+            self.statements = compiled.statements
+        except Exception as error:
+            # Not every statement may have run, reload it all next time.
+            self.statements = None
+            self.last_error = error
+            report_error(error)
+        self.definitions = compiled.definitions
+
+    def new_namespace(self):
+        return {'__name__': '__livecode__', 'assets': self.assets}
 
-    def repl(self, code):
-        compiled = ""
-        for l, line in enumerate(code):
-            compiled += line + '\n'
+    def reload(self, compiled):
         self.reset_showbase()
+        self.namespace = self.new_namespace()
+        exec(compiled.code, self.namespace)
+
+    def execute(self, source):
+        # Runs a snippet in the running code's namespace, like a console.
+        # Returns what it printed and the repr of a trailing expression.
+        if self.namespace is None:
+            self.namespace = self.new_namespace()
+        lines = source.splitlines(True)
+        linecache.cache[SNIPPET] = (len(source), None, lines, SNIPPET)
+        output = StringIO()
+        result = None
         try:
-            exec(compiled)
-        except:
-            print("error")
+            module = ast.parse(source, SNIPPET)
+            expression = None
+            if module.body and isinstance(module.body[-1], ast.Expr):
+                expression = ast.Expression(module.body.pop().value)
+            with redirect_stdout(output):
+                exec(compile(module, SNIPPET, 'exec'), self.namespace)
+                if expression:
+                    code = compile(expression, SNIPPET, 'eval')
+                    result = repr(eval(code, self.namespace))
+        except Exception as error:
+            return {
+                'ok': False, 'output': output.getvalue(),
+                'error': format_error(error, SNIPPET),
+            }
+        return {'ok': True, 'output': output.getvalue(), 'result': result}
+
+    def patch(self, compiled):
+        for name in self.definitions:
+            if name not in compiled.definitions:
+                self.namespace.pop(name, None)
+        for name, definition in compiled.definitions.items():
+            if self.definitions.get(name) == definition:
+                continue
+            old = self.namespace.get(name)
+            exec(compiled.codes[name], self.namespace)
+            new = self.namespace[name]
+            if isinstance(old, type) and isinstance(new, type):
+                update_class(old, new)
+                self.namespace[name] = old
+            elif update_function(old, new):
+                self.namespace[name] = old
+
+
+def report_error(error):
+    print(format_error(error), end='')
+
+def format_error(error, filename=FILENAME):
+    if isinstance(error, SyntaxError):
+        text = '{}: {} (line {})\n'.format(
+            type(error).__name__, error.msg, error.lineno
+        )
+        if error.text:
+            text += '    ' + error.text.strip() + '\n'
+        return text
+    # Only show the frames that are in the live code.
+    frames = [
+        frame for frame in traceback.extract_tb(error.__traceback__)
+        if frame.filename == filename
+    ]
+    return ''.join(
+        ['Traceback (most recent call last):\n']
+        + traceback.format_list(frames)
+        + traceback.format_exception_only(type(error), error)
+    )
+
+
+def update_function(old, new):
+    # Swap the code of the existing function, so everything still holding
+    # on to it (bound methods passed to the task manager etc.) runs the
+    # new version.
+    if not (callable(old) and hasattr(old, '__code__')):
+        return False
+    if not hasattr(new, '__code__'):
+        return False
+    if old.__code__.co_freevars != new.__code__.co_freevars:
+        return False
+    old.__code__ = new.__code__
+    old.__defaults__ = new.__defaults__
+    old.__kwdefaults__ = new.__kwdefaults__
+    old.__annotations__ = new.__annotations__
+    old.__doc__ = new.__doc__
+    return True
+
+
+def update_class(old, new):
+    for name in list(old.__dict__):
+        if name not in new.__dict__ and name not in SKIP_ATTRIBUTES:
+            delattr(old, name)
+    for name, value in new.__dict__.items():
+        if name in SKIP_ATTRIBUTES:
+            continue
+        current = old.__dict__.get(name)
+        if isinstance(value, (staticmethod, classmethod)):
+            if type(current) is type(value):
+                if update_function(current.__func__, value.__func__):
+                    continue
+        elif update_function(current, value):
+            continue
+        setattr(old, name, value)
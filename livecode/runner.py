@@ -0,0 +1,150 @@
+# Runs a live-code script without the editor, the same way the editor's
+# Repl does, and reports how well it holds frame rate:
+#
+#   python -m livecode.runner example/__init__.py --frames 600 --output run.json
+#
+# The clock is simulated at --fps, so a run covers the same game time on
+# any machine. With --reloads the script is restarted that many times along
+# the way, node and task counts after each restart show what leaks across
+# them. --budget-ms fails the run (exit code 1) when the 99th percentile
+# frame takes longer, for use in CI.
+import sys
+import json
+import time
+import math
+import argparse
+from panda3d.core import ClockObject
+from .headless import make_headless_base
+from .bench import summary
+
+
+class Runner():
+    def __init__(self, window_type='none', fps=60, throttle=False):
+        self.base = make_headless_base(window_type)
+        from .repl import Repl
+        self.repl = Repl()
+        if not throttle:
+            # Measure slow tasks as they are instead of holding them back.
+            self.repl.tasks.strikes = math.inf
+        self.clock = ClockObject.get_global_clock()
+        self.clock.set_mode(ClockObject.M_non_real_time)
+        self.clock.set_frame_rate(fps)
+        self.frame_times = []
+        self.samples = []
+        self.loads = 0
+        self.task_reports = []
+
+    def load(self, source):
+        # Through Repl.repl(), so it's compiled and run like from the editor.
+        # Restarting clears the task timings, keep the ones so far.
+        self.keep_task_report()
+        self.loads += 1
+        self.repl.repl(source.split('\n'), full=True)
+        while self.repl.pending:
+            self.base.task_mgr.step()
+        self.sample('loaded')
+        return self.repl.last_error
+
+    def step(self):
+        start = time.perf_counter()
+        self.base.task_mgr.step()
+        self.frame_times.append(time.perf_counter() - start)
+
+    def sample(self, event):
+        self.samples.append({
+            'event': event,
+            'frame': len(self.frame_times),
+            'render_nodes': self.base.render.count_num_descendants(),
+            'tasks': len(self.base.task_mgr.getTasks()),
+        })
+
+    def run(self, source, frames, reloads=0, sample_every=60):
+        error = self.load(source)
+        if error:
+            return error
+        self.repl.tasks.window = frames
+        reload_every = frames // (reloads+1)
+        for frame in range(1, frames+1):
+            self.step()
+            if frame % sample_every == 0:
+                self.sample('frame')
+            if reloads and frame % reload_every == 0 and frame < frames:
+                error = self.load(source)
+                if error:
+                    return error
+        self.sample('done')
+
+    def keep_task_report(self):
+        for stats in self.repl.tasks.report():
+            stats['load'] = self.loads
+            self.task_reports.append(stats)
+        self.repl.tasks.clear()
+
+    def report(self):
+        self.keep_task_report()
+        return {
+            'frame': summary(self.frame_times) if self.frame_times else None,
+            'frame_times_ms': [t*1000 for t in self.frame_times],
+            'tasks': self.task_reports,
+            'samples': self.samples,
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run live code headless')
+    parser.add_argument('script')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--duration', type=float,
+        help='simulated seconds to run, instead of --frames')
+    parser.add_argument('--fps', type=float, default=60)
+    parser.add_argument('--reloads', type=int, default=0)
+    parser.add_argument('--window-type', default='none')
+    parser.add_argument('--throttle', action='store_true',
+        help='throttle and pause slow tasks like the editor does')
+    parser.add_argument('--budget-ms', type=float)
+    parser.add_argument('--output', default='run.json')
+    args = parser.parse_args(args)
+    frames = args.frames
+    if args.duration is not None:
+        frames = int(args.duration*args.fps)
+
+    with open(args.script) as f:
+        source = f.read()
+    runner = Runner(args.window_type, args.fps, args.throttle)
+    error = runner.run(source, frames, args.reloads)
+    report = runner.report()
+    report.update({
+        'script': args.script,
+        'frames': frames,
+        'fps': args.fps,
+        'window_type': args.window_type,
+        'reloads': args.reloads,
+        'error': None,
+        'over_budget': False,
+    })
+    if error:
+        from .repl import format_error
+        report['error'] = format_error(error)
+    elif args.budget_ms is not None and report['frame']:
+        report['over_budget'] = report['frame']['p99_ms'] > args.budget_ms
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if report['frame']:
+        print('{} frames  p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms'.format(
+            frames, report['frame']['p50_ms'], report['frame']['p99_ms'],
+            report['frame']['max_ms'],
+        ))
+    for sample in runner.samples:
+        if sample['event'] != 'frame':
+            print('{:>7} at frame {}: {} nodes, {} tasks'.format(
+                sample['event'], sample['frame'], sample['render_nodes'],
+                sample['tasks'],
+            ))
+    print('saved {}!'.format(args.output))
+    if report['error'] or report['over_budget']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+from math import floor
+from panda3d.core import NodePath
+
+
+class NodePool():
+    # Recycles copies of a model instead of copying a new one for every
+    # spawn and throwing it away when it dies.
+    def __init__(self, model, size=0):
+        self.model = model
+        self.free = []
+        self.active = 0
+        for i in range(size):
+            self.free.append(self.copy())
+
+    def copy(self):
+        return NodePath(self.model.node().copy_subgraph())
+
+    def get(self, parent=None):
+        if self.free:
+            node = self.free.pop()
+        else:
+            node = self.copy()
+        node.reparent_to(parent or render)
+        self.active += 1
+        return node
+
+    def release(self, node):
+        node.detach_node()
+        node.set_transform(self.model.get_transform())
+        self.free.append(node)
+        self.active -= 1
+
+    def clear(self):
+        for node in self.free:
+            node.remove_node()
+        self.free = []
+
+
+class SpatialHash():
+    # Items bucketed in a uniform grid on the xy plane, so looking for what's
+    # near a point only checks the cells around it instead of everything.
+    # Cells should be about as big as the largest query radius.
+    def __init__(self, cell_size=2):
+        self.cell_size = cell_size
+        self.cells = {} # (x, y): {item: (x, y)}
+        self.items = {} # item: (x, y) cell
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def cell(self, x, y):
+        return floor(x/self.cell_size), floor(y/self.cell_size)
+
+    def update(self, item, x, y):
+        cell = self.cell(x, y)
+        old = self.items.get(item)
+        if old is not None and old != cell:
+            self.remove(item)
+        self.items[item] = cell
+        self.cells.setdefault(cell, {})[item] = (x, y)
+
+    def update_node(self, node):
+        x, y, z = node.get_pos()
+        self.update(node, x, y)
+
+    def remove(self, item):
+        cell = self.items.pop(item, None)
+        if cell is None:
+            return
+        bucket = self.cells[cell]
+        del bucket[item]
+        if not bucket:
+            del self.cells[cell]
+
+    def query(self, x, y, radius):
+        # Items within radius of (x, y), nearest first.
+        left, bottom = self.cell(x-radius, y-radius)
+        right, top = self.cell(x+radius, y+radius)
+        found = []
+        for cx in range(left, right+1):
+            for cy in range(bottom, top+1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for item, (ix, iy) in bucket.items():
+                    distance = (ix-x)**2 + (iy-y)**2
+                    if distance <= radius*radius:
+                        found.append((distance, item))
+        found.sort(key=lambda found: found[0])
+        return [item for distance, item in found]
+
+    def nearest(self, x, y, radius):
+        found = self.query(x, y, radius)
+        return found[0] if found else None
+
+    def clear(self):
+        self.cells = {}
+        self.items = {}
@@ -0,0 +1,40 @@
+POLICIES = ('manual', 'debounce', 'enter')
+
+
+class RunScheduler():
+    # Decides when the buffer gets run:
+    #   manual:   only when asked for (shift-enter)
+    #   debounce: once the buffer has been left alone for self.delay seconds
+    #   enter:    on enter, the Repl skips it if the buffer doesn't parse
+    # A newly scheduled run replaces the pending one, so a burst of typing
+    # results in at most one run.
+    def __init__(self, run, policy='enter', delay=0.5):
+        assert policy in POLICIES
+        self.run = run
+        self.policy = policy
+        self.delay = delay
+        self.task = None
+
+    def edited(self, *args):
+        if self.policy == 'debounce':
+            self.schedule(self.delay)
+
+    def entered(self):
+        if self.policy == 'enter':
+            self.schedule(0)
+
+    def schedule(self, delay):
+        self.cancel()
+        self.task = base.task_mgr.do_method_later(
+            delay, self.fire, 'livecode scheduled run'
+        )
+
+    def cancel(self):
+        if self.task:
+            self.task.remove()
+            self.task = None
+
+    def fire(self, task):
+        self.task = None
+        self.run()
+        return task.done
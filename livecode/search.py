@@ -0,0 +1,78 @@
+import re
+
+
+class Search():
+    # Matches of the current pattern, indexed per line. Lines are only
+    # searched when asked for, and an edit only drops the matches of the
+    # lines it touched.
+    def __init__(self, lines):
+        self.lines = lines
+        self.lines.listeners.append(self.changed)
+        self.pattern = None
+        self.regex = False
+        self.index = []
+
+    def set_pattern(self, query, regex=False):
+        self.regex = regex
+        if query:
+            self.pattern = re.compile(query if regex else re.escape(query))
+        else:
+            self.pattern = None
+        self.index = [None]*len(self.lines)
+
+    def changed(self, start, old, new):
+        if self.pattern:
+            self.index[start:start+len(old)] = [None]*len(new)
+
+    def matches(self, l):
+        if l >= len(self.index):
+            # Lines of a large file that were still being indexed.
+            self.index.extend([None]*(len(self.lines)-len(self.index)))
+        spans = self.index[l]
+        if spans is None:
+            spans = self.index[l] = [
+                match.span() for match in self.pattern.finditer(self.lines[l])
+                if match.end() > match.start()
+            ]
+        return spans
+
+    def find(self, x, y, direction=1):
+        # The first match after (or before) x, y, wrapping around.
+        if not self.pattern or not len(self.lines):
+            return None
+        count = len(self.lines)
+        for i in range(count+1):
+            l = (y + i*direction) % count
+            spans = self.matches(l)
+            if direction < 0:
+                spans = reversed(spans)
+            for start, end in spans:
+                if i == 0 and (start <= x if direction > 0 else start >= x):
+                    continue
+                return l, start, end
+        return None
+
+    def replace_all(self, replacement):
+        # All changed lines as one range, to be applied as a single edit.
+        if not self.pattern:
+            return None
+        if not self.regex:
+            replacement = replacement.replace('\\', '\\\\')
+        first = last = None
+        for l in range(len(self.lines)):
+            if self.matches(l):
+                if first is None:
+                    first = l
+                last = l
+        if first is None:
+            return None
+        # Empty matches are left alone, like matches() leaves them out.
+        def replace(match):
+            if match.end() > match.start():
+                return match.expand(replacement)
+            return ''
+        lines = self.lines[first:last+1]
+        for i, line in enumerate(lines):
+            if self.index[first+i]:
+                lines[i] = self.pattern.sub(replace, line)
+        return first, lines
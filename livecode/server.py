@@ -0,0 +1,242 @@
+# Lets other programs push code into the running editor over a localhost
+# socket. Messages both ways are a 4 byte big-endian length followed by
+# that many bytes of UTF-8 JSON:
+#
+#   {"type": "code", "source": "game.player.get_pos()"}
+#       runs a snippet in the live namespace, replies with its output
+#       and the repr of a trailing expression
+#   {"type": "patch", "start": 3, "stop": 4, "lines": ["x = 1"], "run": true}
+#       replaces lines start:stop of the open buffer, optionally runs it
+#   {"type": "run", "full": false}
+#       runs the buffer, replies once it has run
+#
+# Replies carry "ok", "error" when it's false, and the message's "id".
+#
+#   python -m livecode.server --port 7337 snippet.py
+import sys
+import json
+import socket
+import struct
+import argparse
+import selectors
+from collections import deque
+from .repl import format_error
+
+
+PORT = 7337
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 64*1024*1024
+
+
+def frame(message):
+    data = json.dumps(message).encode()
+    return HEADER.pack(len(data)) + data
+
+
+class Connection():
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.closed = False
+
+    def receive(self):
+        # Returns the messages that came in completely.
+        try:
+            data = self.sock.recv(64*1024)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            self.closed = True
+            return []
+        self.inbox += data
+        messages = []
+        while len(self.inbox) >= HEADER.size:
+            length, = HEADER.unpack_from(self.inbox)
+            if length > MAX_MESSAGE:
+                self.closed = True
+                break
+            if len(self.inbox) < HEADER.size+length:
+                break
+            data = bytes(self.inbox[HEADER.size:HEADER.size+length])
+            del self.inbox[:HEADER.size+length]
+            try:
+                message = json.loads(data)
+            except ValueError as error:
+                message = {'type': 'invalid', 'error': str(error)}
+            if not isinstance(message, dict):
+                message = {'type': 'invalid', 'error': 'not a JSON object'}
+            messages.append(message)
+        return messages
+
+    def send(self, message):
+        self.outbox += frame(message)
+        self.flush()
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.outbox)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.closed = True
+            return
+        del self.outbox[:sent]
+
+
+class ReplServer():
+    # Polled from a task, so it never blocks a frame. Messages are handled
+    # on the main thread in the order they came in.
+    def __init__(self, editor, port=PORT, host='127.0.0.1'):
+        self.editor = editor
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+        self.queue = deque() # (connection, message)
+        self.waiting = [] # (connection, message) for runs still compiling
+        print('listening on {}:{}!'.format(host, self.port))
+
+    def poll(self, task):
+        for key, mask in self.selector.select(0):
+            if key.data is None:
+                self.accept()
+                continue
+            connection = key.data
+            if mask & selectors.EVENT_READ:
+                for message in connection.receive():
+                    self.queue.append((connection, message))
+            if mask & selectors.EVENT_WRITE:
+                connection.flush()
+        while self.queue:
+            self.handle(*self.queue.popleft())
+        if self.waiting and not self.editor.repl.pending:
+            for connection, message in self.waiting:
+                self.reply(connection, message, self.run_result())
+            self.waiting = []
+        for connection in self.connections[:]:
+            self.update_connection(connection)
+        return task.cont
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(sock)
+        self.connections.append(connection)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def update_connection(self, connection):
+        if connection.closed:
+            self.selector.unregister(connection.sock)
+            connection.sock.close()
+            self.connections.remove(connection)
+            return
+        events = selectors.EVENT_READ
+        if connection.outbox:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(connection.sock).events != events:
+            self.selector.modify(connection.sock, events, connection)
+
+    def handle(self, connection, message):
+        kind = message.get('type')
+        try:
+            if kind == 'code':
+                result = self.editor.repl.execute(message['source'])
+            elif kind == 'patch':
+                self.editor.apply_patch(
+                    message['start'], message['stop'], message['lines'],
+                )
+                result = {'ok': True}
+                if message.get('run'):
+                    return self.run(connection, message)
+            elif kind == 'run':
+                return self.run(connection, message)
+            elif kind == 'invalid':
+                result = {'ok': False, 'error': message['error']}
+            else:
+                result = {'ok': False, 'error': 'unknown type {}'.format(kind)}
+        except Exception as error:
+            result = {'ok': False, 'error': '{}: {}'.format(
+                type(error).__name__, error
+            )}
+        self.reply(connection, message, result)
+
+    def run(self, connection, message):
+        # Compiling happens on the Repl's thread, so reply once it's run.
+        self.editor.run(message.get('full', False))
+        if self.editor.repl.pending:
+            self.waiting.append((connection, message))
+        else:
+            self.reply(connection, message, self.run_result())
+
+    def run_result(self):
+        error = self.editor.repl.last_error
+        if error is None:
+            return {'ok': True}
+        return {'ok': False, 'error': format_error(error)}
+
+    def reply(self, connection, message, result):
+        if 'id' in message:
+            result['id'] = message['id']
+        if not connection.closed:
+            connection.send(result)
+
+    def close(self):
+        for connection in self.connections[:]:
+            connection.closed = True
+            self.update_connection(connection)
+        self.selector.unregister(self.listener)
+        self.listener.close()
+
+
+def request(message, port=PORT, host='127.0.0.1', timeout=5):
+    # Sends one message and waits for its reply, for tools and tests.
+    with socket.create_connection((host, port), timeout) as sock:
+        sock.sendall(frame(message))
+        header = receive_exactly(sock, HEADER.size)
+        length, = HEADER.unpack(header)
+        return json.loads(receive_exactly(sock, length))
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size-len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run code in the editor')
+    parser.add_argument('filename', nargs='?', help='defaults to stdin')
+    parser.add_argument('--port', type=int, default=PORT)
+    args = parser.parse_args(args)
+    if args.filename:
+        with open(args.filename) as f:
+            source = f.read()
+    else:
+        source = sys.stdin.read()
+    reply = request({'type': 'code', 'source': source}, args.port)
+    if reply.get('output'):
+        print(reply['output'], end='')
+    if reply.get('result') is not None:
+        print(reply['result'])
+    if not reply['ok']:
+        print(reply['error'], end='', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+from queue import Queue
+from threading import Thread
+
+
+class FileWriter():
+    # All file writes happen one after the other on this thread, so saving
+    # never holds up a frame and jobs land on disk in the order given.
+    def __init__(self):
+        self.jobs = Queue()
+        self.thread = Thread(target=self.work, name='livecode writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def put(self, job, *args):
+        self.jobs.put((job, args))
+
+    def work(self):
+        while True:
+            job, args = self.jobs.get()
+            try:
+                job(*args)
+            except Exception as error:
+                print('writing failed: {}'.format(error))
+            finally:
+                self.jobs.task_done()
+
+    def wait(self):
+        self.jobs.join()
+
+    def busy(self):
+        return self.jobs.unfinished_tasks > 0
+
+
+class Journal():
+    # Edits to the open file are appended to a journal next to it, in
+    # batches every flush_interval seconds. After a crash, loading the
+    # file replays whatever was journaled since it was last saved. The
+    # journal is only written once there are edits, and removed again on
+    # saving and on a clean exit.
+    def __init__(self, writer, flush_interval=1.0):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.path = None
+        self.filename = None
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.replaying = False
+
+    def record(self, start, old, new):
+        if self.path and not self.replaying:
+            self.pending.append([start, len(old), list(new)])
+
+    def update(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.path and self.pending:
+            batch, self.pending = self.pending, []
+            self.writer.put(append_journal, self.path, self.filename, batch)
+
+    def open(self, filename):
+        # Returns the edits to recover, if there's a journal for this
+        # version of the file.
+        self.close()
+        self.writer.wait()
+        self.path = journal_path(filename)
+        self.filename = filename
+        edits = read_journal(self.path, filename)
+        if edits is None:
+            # Left from an older version of the file.
+            self.writer.put(remove_file, self.path)
+        return edits or []
+
+    def replay(self, lines, edits):
+        self.replaying = True
+        try:
+            for start, removed, new in edits:
+                lines.splice(start, start+removed, new)
+        finally:
+            self.replaying = False
+
+    def save(self, filename, lines):
+        # The journal only starts over once the file is safely written.
+        self.flush()
+        path = journal_path(filename)
+        if path != self.path:
+            self.close()
+            self.path = path
+        self.filename = filename
+        self.writer.put(save_file, filename, lines, path)
+
+    def reset(self, filename):
+        # The lines match the file on disk again.
+        self.pending = []
+        self.path = journal_path(filename)
+        self.filename = filename
+        self.writer.put(remove_file, self.path)
+
+    def close(self):
+        if self.path:
+            self.pending = []
+            self.writer.put(remove_file, self.path)
+        self.path = None
+        self.filename = None
+
+
+def journal_path(filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, '.{}.journal'.format(name))
+
+def file_version(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def write_atomic(filename, lines):
+    # Write a temporary file next to the target, then rename it over.
+    filename = os.path.abspath(filename)
+    directory, name = os.path.split(filename)
+    fd, temp = tempfile.mkstemp(prefix='.'+name+'.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as file:
+            for line in lines:
+                file.write(line+'\n')
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(filename):
+            os.chmod(temp, os.stat(filename).st_mode)
+        os.replace(temp, filename)
+    except BaseException:
+        os.remove(temp)
+        raise
+    sync_directory(directory)
+
+def sync_directory(directory):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def save_file(filename, lines, journal):
+    write_atomic(filename, lines)
+    remove_file(journal)
+
+def append_journal(path, filename, edits):
+    # The first batch starts the journal with the version of the file
+    # the edits apply to.
+    new = not os.path.exists(path)
+    with open(path, 'a') as file:
+        if new:
+            file.write(json.dumps(file_version(filename))+'\n')
+        for edit in edits:
+            file.write(json.dumps(edit)+'\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+def read_journal(path, filename):
+    try:
+        with open(path) as file:
+            entries = file.read().split('\n')
+    except OSError:
+        return None
+    try:
+        if json.loads(entries[0]) != file_version(filename):
+            return None
+    except ValueError:
+        return None
+    edits = []
+    for entry in entries[1:]:
+        try:
+            edits.append(json.loads(entry))
+        except ValueError:
+            # A batch cut off by the crash, everything before it is fine.
+            break
+    return edits
+
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
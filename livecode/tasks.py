@@ -0,0 +1,89 @@
+import time
+from collections import deque
+from direct.task.Task import Task
+
+
+class TaskStats():
+    def __init__(self, name, window):
+        self.name = name
+        self.times = deque(maxlen=window)
+        self.calls = 0
+        self.total = 0
+        self.strikes = 0 # Frames over budget in a row.
+        self.state = 'running' # or 'throttled' or 'paused'
+
+    @property
+    def average(self):
+        return self.total / self.calls if self.calls else 0
+
+    def as_dict(self):
+        times = sorted(self.times)
+        return {
+            'name': self.name,
+            'state': self.state,
+            'calls': self.calls,
+            'mean_ms': self.average*1000,
+            'p50_ms': times[len(times)//2]*1000 if times else 0,
+            'max_ms': times[-1]*1000 if times else 0,
+        }
+
+
+class TaskProfiler():
+    # Times every task the live code adds and keeps it to a frame budget.
+    # A task over budget for `strikes` frames in a row is throttled to run
+    # every `throttle` frames, and if it still goes over, it is paused.
+    def __init__(self, budget=0.008, strikes=30, throttle=4, window=120):
+        self.budget = budget
+        self.strikes = strikes
+        self.throttle = throttle
+        self.window = window
+        self.stats = {} # task id: TaskStats
+
+    def scan(self, ignore):
+        for task in base.task_mgr.getTasks():
+            if task.get_task_id() not in self.stats and task not in ignore:
+                self.wrap(task)
+
+    def wrap(self, task):
+        stats = TaskStats(task.get_name(), self.window)
+        self.stats[task.get_task_id()] = stats
+        function = task.get_function()
+        def timed_task(*args):
+            if stats.state == 'paused':
+                return Task.cont
+            if stats.state == 'throttled':
+                if globalClock.get_frame_count() % self.throttle:
+                    return Task.cont
+            start = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                self.measure(stats, time.perf_counter() - start)
+        task.set_function(timed_task)
+
+    def measure(self, stats, elapsed):
+        stats.times.append(elapsed)
+        stats.calls += 1
+        stats.total += elapsed
+        if elapsed <= self.budget:
+            stats.strikes = 0
+            return
+        stats.strikes += 1
+        if stats.strikes >= self.strikes and stats.state != 'paused':
+            stats.state = 'throttled' if stats.state == 'running' else 'paused'
+            stats.strikes = 0
+            print('task {} took {:.1f}ms, over the {:.1f}ms budget, {}!'.format(
+                stats.name, elapsed*1000, self.budget*1000, stats.state
+            ))
+
+    def resume(self):
+        # New code gets another chance.
+        for stats in self.stats.values():
+            stats.state = 'running'
+            stats.strikes = 0
+
+    def clear(self):
+        self.stats = {}
+
+    def report(self):
+        return [stats.as_dict() for stats in self.stats.values()]
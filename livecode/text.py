@@ -1,9 +1,15 @@
+import os
 from panda3d.core import NodePath
+from panda3d.core import PandaNode
 from panda3d.core import TextNode
 from panda3d.core import TextAssembler
 from panda3d.core import TextPropertiesManager
-from panda3d.core import CardMaker
+from panda3d.core import TransformState
+from panda3d.core import Geom, GeomNode, GeomTriangles, GeomEnums
+from panda3d.core import GeomVertexData, GeomVertexFormat, GeomVertexWriter
 from direct.showbase.DirectObject import DirectObject
+from .buffer import LineBuffer
+from .profile import timed
 
 
 def fill(string, n): return "{:<{}}".format(string, n)[:n]
@@ -15,14 +21,26 @@ class TextFileNode(TextNode):
         self.set_shadow(0.08)
         self.set_shadow_color((0,0,0,1))
         self.x = self.y = 0
-        self.lines = ['']
+        self.buffer = LineBuffer([''])
         self.show_line_number = True
         self.line_number_width = 4
         self.max_rows = 30
         self.hidden = False
+        self.rows = None
+        # Files this big are memory-mapped and read lazily.
+        self.large_file_size = 8*1024*1024
+        self.large_file = False
         if filename:
             self.load_file(filename)
 
+    @property
+    def lines(self):
+        return self.buffer
+
+    @lines.setter
+    def lines(self, lines):
+        self.buffer.set_lines(lines)
+
     @property
     def line(self):
         return self.lines[self.y]
@@ -38,6 +56,7 @@ class TextFileNode(TextNode):
     def new_file(self):
         self.x = self.y = 0
         self.lines = ['']
+        self.large_file = False
         self.refresh()
 
     def load_file(self, filename=None):
@@ -47,15 +66,18 @@ class TextFileNode(TextNode):
             filename = self.filename
              # TODO: Ask filename
         print('loading file {}!'.format(filename))
-        self.lines = []
-        self.text = ''
-        with open(filename) as f:
-            content = f.readlines()
-        for line in content:
-            line = line.strip('\n')
-            self.lines.append(line)
+        self.read_file(filename)
         self.refresh()
-        self.run()
+        if not self.large_file:
+            self.run_loaded()
+
+    def read_file(self, filename):
+        self.large_file = os.path.getsize(filename) >= self.large_file_size
+        if self.large_file:
+            self.lines.load_mapped(filename)
+        else:
+            with open(filename) as f:
+                self.lines = [line.strip('\n') for line in f] or ['']
 
     def save_file(self, filename=None):
         if filename:
@@ -65,50 +87,217 @@ class TextFileNode(TextNode):
             # TODO: Ask filename
         print('saving as {}!'.format(filename))
         self.filename = filename
-        file = open(filename, 'w')
-        for line in self.lines:
-            file.write(line+'\n')
-        file.close()
+        # Read everything before truncating, lines may come from the file.
+        content = ''.join(line+'\n' for line in self.lines)
+        with open(filename, 'w') as file:
+            file.write(content)
 
     def hide(self):
         self.hidden = not self.hidden
         self.refresh()
 
+    def format_line_number(self, l):
+        return fill(str(l),3)+' '
+
+    def format_lines(self, start, end):
+        return self.lines[start:end]
+
+    @timed('write_out')
     def write_out(self):
-        self.text = ''
+        # Only the rows in view are formatted, and the text is left alone
+        # when they come out the same as last time.
         if self.hidden:
+            rows = []
+        else:
+            start = self.line_offset
+            lines = self.format_lines(start, start+self.max_rows)
+            if self.show_line_number:
+                rows = [
+                    (self.format_line_number(l), line)
+                    for l, line in enumerate(lines, start)
+                ]
+            else:
+                rows = [('', line) for line in lines]
+        if rows == self.rows:
             return
-        for l, line in enumerate(self.lines):
-            if l >= self.line_offset:
-                if self.show_line_number:
-                    self.text += fill(str(l),3)+' '
-                self.text += line + "\n"
-            if l > self.line_offset+self.max_rows-1:
-                return
+        self.rows = rows
+        self.draw_rows(rows)
+
+    def draw_rows(self, rows):
+        self.text = '\n'.join(number + line for number, line in rows)
 
     def refresh(self):
         self.write_out()
 
 
+class TextTiles():
+    # A pool of small TextNodes, one per visible piece of text, parented to
+    # a node and keyed by their text. Text that is still on screen keeps
+    # its tile (just moved when scrolling), so only new or changed text
+    # gets its glyphs generated again.
+    def __init__(self, parent, line_height):
+        self.parent = parent
+        self.line_height = line_height
+        self.tiles = {} # text: [tiles]
+        self.free = []
+
+    def draw(self, cells):
+        # Cells are (text, x, row).
+        old, self.tiles = self.tiles, {}
+        new = []
+        for text, x, row in cells:
+            if old.get(text):
+                self.place(old[text].pop(), text, x, row)
+            else:
+                new.append((text, x, row))
+        for tiles in old.values():
+            for tile in tiles:
+                self.parent.remove_child(tile)
+                self.free.append(tile)
+        for text, x, row in new:
+            if self.free:
+                tile = self.free.pop()
+            else:
+                tile = TextNode('line', self.parent)
+            tile.set_text(text)
+            self.parent.add_child(tile)
+            self.place(tile, text, x, row)
+
+    def place(self, tile, text, x, row):
+        # TextNode.set_transform is the text's own transform, which would
+        # regenerate it; move the node instead.
+        transform = TransformState.make_pos((x, 0, -row*self.line_height))
+        PandaNode.set_transform(tile, transform)
+        self.tiles.setdefault(text, []).append(tile)
+
+    def clear(self):
+        self.draw([])
+
+
+class RectOverlay():
+    # Flat rectangles (selection, cursor) batched into a single GeomNode.
+    # The vertex and index data are reused between redraws and only ever
+    # grow, clearing just resets the amount of rectangles to draw.
+    def __init__(self, name):
+        vertex_format = GeomVertexFormat.get_v3c4()
+        vdata = GeomVertexData(name, vertex_format, Geom.UH_dynamic)
+        self.triangles = GeomTriangles(Geom.UH_dynamic)
+        self.triangles.set_index_type(GeomEnums.NT_uint32)
+        self.geom = Geom(vdata)
+        self.geom.add_primitive(self.triangles)
+        self.node = GeomNode(name)
+        self.node.add_geom(self.geom)
+        self.capacity = 0
+        self.count = 0
+        self.indices = None
+        self.vertex = self.color = None
+
+    def clear(self):
+        self.count = 0
+
+    def add(self, left, right, bottom, top, color):
+        if self.vertex is None:
+            vdata = self.geom.modify_vertex_data()
+            self.vertex = GeomVertexWriter(vdata, 'vertex')
+            self.color = GeomVertexWriter(vdata, 'color')
+        if self.count >= self.capacity:
+            self.grow(max(16, self.capacity*2))
+        row = self.count*4
+        self.vertex.set_row(row)
+        self.color.set_row(row)
+        for x, z in ((left, bottom), (right, bottom), (right, top), (left, top)):
+            self.vertex.set_data3(x, 0, z)
+            self.color.set_data4(color)
+        self.count += 1
+
+    def grow(self, capacity):
+        vdata = self.geom.modify_vertex_data()
+        vdata.set_num_rows(capacity*4)
+        self.vertex = GeomVertexWriter(vdata, 'vertex')
+        self.color = GeomVertexWriter(vdata, 'color')
+        self.triangles.clear_vertices()
+        for i in range(0, capacity*4, 4):
+            self.triangles.add_vertices(i, i+1, i+2)
+            self.triangles.add_vertices(i, i+2, i+3)
+        self.indices = self.triangles.get_vertices()
+        self.capacity = capacity
+
+    def commit(self):
+        if self.indices is not None:
+            self.triangles.set_vertices(self.indices, self.count*6)
+        self.vertex = self.color = None
+
+
+class Selection():
+    # The selection is two (x, y) anchors into the lines: where selecting
+    # started and where the cursor went. Both are moved along as lines are
+    # inserted or removed above them, and the text is only read out when
+    # it's copied or cut.
+    def __init__(self, lines):
+        self.lines = lines
+        self.anchor = None
+        self.head = None
+        self.lines.listeners.append(self.changed)
+
+    def __bool__(self):
+        return self.anchor is not None and self.anchor != self.head
+
+    def start(self, x, y):
+        self.anchor = [x, y]
+        self.head = [x, y]
+
+    def clear(self):
+        self.anchor = self.head = None
+
+    def range(self):
+        # The two ends as ((x, y), (x, y)), in reading order.
+        a, b = self.anchor, self.head
+        if (a[1], a[0]) > (b[1], b[0]):
+            a, b = b, a
+        return tuple(a), tuple(b)
+
+    def text(self):
+        (x1, y1), (x2, y2) = self.range()
+        if y1 == y2:
+            return [self.lines[y1][x1:x2]]
+        lines = self.lines[y1:y2+1]
+        lines[0] = lines[0][x1:]
+        lines[-1] = lines[-1][:x2]
+        return lines
+
+    def changed(self, start, old, new):
+        if self.anchor is None:
+            return
+        for point in (self.anchor, self.head):
+            if point[1] >= start+len(old):
+                point[1] += len(new)-len(old)
+            elif point[1] >= start:
+                # In the lines that were replaced, keep it on what's there.
+                point[1] = max(0, min(point[1], start+len(new)-1))
+                if point[1] < len(self.lines):
+                    point[0] = min(point[0], len(self.lines[point[1]]))
+
+
 class TextFileSelectionNode(DirectObject, TextFileNode):
     def __init__(self, name, filename=None, **options):
         DirectObject.__init__(self)
         TextFileNode.__init__(self, name, None, **options)
 
-        self.cardmaker = CardMaker('selection cards')
-        self.selection_cards = []
+        self.overlay = RectOverlay('selection')
+        self.add_child(self.overlay.node)
+        self.selection = Selection(self.lines)
         self.selecting = False
         self.rect_w, self.rect_h = 1, 1
 
+        self.setup_select_input()
+
+    def setup_select_input(self):
         self.accept('shift', self.toggle_select, extraArgs=[True])
         self.accept('shift-up', self.toggle_select, extraArgs=[False])
 
     # Selection editing
     def clear_rects(self):
-        for card in self.selection_cards:
-            if card in list(self.children):
-                self.remove_child(card)
-        self.selection_cards = []
+        self.overlay.clear()
 
     def draw_rect(self, rect, color=(1,1,1,1)):
         rx, ry, rw, rh = rect
@@ -116,66 +305,35 @@ class TextFileSelectionNode(DirectObject, TextFileNode):
         r = ((rx+rw+1)*self.rect_w)-0.2
         u = ((ry-1)*self.rect_h)+0.5
         d = ((ry+rh)*self.rect_h)+0.3
-        self.cardmaker.set_frame(l,r,-u,-d)
-        self.cardmaker.set_color(color)
-        card = self.cardmaker.generate()
-        self.add_child(card)
-        return card
-
-    def draw_line_rect(self, line_number, start, end=0):
-        x = self.line_number_width+start
-        y = line_number-self.line_offset
-        w = len(self.lines[line_number])-start
-        if end:
-            w = min(w,end)
-        self.selection_cards.append(self.draw_rect([x,y,w,0]))
+        self.overlay.add(l,r,-u,-d,color)
 
     def remove_range(self):
-        end, start = self.selection_direction()
-        if start[1] == end[1]:
-            a = self.lines[start[1]][:end[0]]
-            b = self.lines[start[1]][start[0]:]
-            self.lines[start[1]] = a + b
-            self.x, self.y = end
-        else:
-            a = self.lines[start[1]][:start[0]]
-            b = self.lines[end[1]][end[0]:]
-            self.lines[start[1]] = a + b
-            for i in range(1, (end[1]-start[1])+2):
-                self.lines.pop(start[1]+1)
-            self.x, self.y = start
+        (x1, y1), (x2, y2) = self.selection.range()
+        a = self.lines[y1][:x1]
+        b = self.lines[y2][x2:]
+        self.selection.clear()
+        self.lines.splice(y1, y2+1, [a + b])
+        self.x, self.y = x1, y1
 
+    @timed('select_range')
     def select_range(self):
+        # Only the rows on screen are drawn, however much is selected.
         self.clear_rects()
-        self.selection_buffer = []
-        start, end = self.selection_direction()
-        if start[1] == end[1]:
-            self.draw_line_rect(start[1], end[0], start[0]-end[0])
-            self.selection_buffer.append(self.lines[start[1]][start[0]:end[0]])
-        else:
-            if start[0] > 0:
-                self.draw_line_rect(start[1], 0, start[0])
-                self.selection_buffer.append(self.lines[start[1]][:start[0]])
-            for i in range(1, start[1]-end[1]):
-                i = start[1] - i
-                self.draw_line_rect(i,0)
-                self.selection_buffer.append(self.lines[i])
-            self.draw_line_rect(end[1], end[0])
-            self.selection_buffer.append(self.lines[end[1]][start[0]:])
-
-    def selection_direction(self):
-        if self.y > self.selection_start[1]:
-            return (self.x, self.y), self.selection_start
-        else:
-            return self.selection_start, (self.x, self.y)
+        if self.selection.anchor is None:
+            self.selection.start(self.x, self.y)
+        self.selection.head = [self.x, self.y]
+        if not self.selection:
+            return
+        (x1, y1), (x2, y2) = self.selection.range()
+        offset = self.line_offset
+        last = min(y2, offset+self.max_rows-1, len(self.lines)-1)
+        for y in range(max(y1, offset), last+1):
+            start = x1 if y == y1 else 0
+            end = x2 if y == y2 else len(self.lines[y])+1
+            if end > start:
+                self.draw_rect([self.line_number_width+start, y-offset, end-start-1, 0])
 
     def toggle_select(self, on=True):
-        if len(self.selection_buffer) > 0:
-            already_selecting = True
-        else:
-            already_selecting = False
         self.selecting = on
-        if self.selecting and not already_selecting:
-            self.selection_start = [self.x, self.y]
-
-
+        if self.selecting and not self.selection:
+            self.selection.start(self.x, self.y)
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import struct
+from difflib import SequenceMatcher
+
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT = struct.Struct('iIII')
+
+
+class FileWatcher():
+    # Tells which watched files changed on disk since the last poll. On
+    # Linux, inotify says which directories saw activity so only their
+    # files get looked at. Elsewhere every file's stat is checked each
+    # interval seconds.
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.last_poll = time.monotonic()
+        self.files = {} # path: (size, mtime)
+        self.pending = set()
+        self.directories = {} # directory: watch descriptor
+        self.inotify = Inotify() if sys.platform.startswith('linux') else None
+        if self.inotify and self.inotify.fd < 0:
+            self.inotify = None
+
+    def watch(self, filename):
+        path = os.path.abspath(filename)
+        self.files[path] = file_version(path)
+        directory = os.path.dirname(path)
+        if self.inotify and directory not in self.directories:
+            self.directories[directory] = self.inotify.add(directory)
+
+    def unwatch(self, filename):
+        self.files.pop(os.path.abspath(filename), None)
+
+    def touch(self, filename):
+        # The file was changed by us, not worth reporting.
+        path = os.path.abspath(filename)
+        if path in self.files:
+            self.files[path] = file_version(path)
+
+    def poll(self, busy=False):
+        # While busy (saving), changes are held on to for the next poll.
+        if self.inotify:
+            self.pending.update(self.inotify_changes())
+        elif time.monotonic() - self.last_poll >= self.interval:
+            self.last_poll = time.monotonic()
+            self.pending.update(self.files)
+        if busy or not self.pending:
+            return []
+        changed = []
+        for path in self.pending:
+            if path not in self.files:
+                continue
+            version = file_version(path)
+            if version and version != self.files[path]:
+                self.files[path] = version
+                changed.append(path)
+        self.pending = set()
+        return changed
+
+    def inotify_changes(self):
+        directories = set()
+        for wd, mask in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                return set(self.files)
+            directories.add(wd)
+        return set(
+            path for path in self.files
+            if self.directories.get(os.path.dirname(path)) in directories
+        )
+
+
+class Inotify():
+    def __init__(self):
+        self.fd = -1
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            pass
+
+    def add(self, directory):
+        return self.libc.inotify_add_watch(self.fd, directory.encode(), IN_MASK)
+
+    def read(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                events.append((wd, mask))
+                offset += EVENT.size + length
+
+
+def file_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def diff_lines(old, new):
+    # Hunks of (start, stop, lines) that turn old into new, last first so
+    # they can be spliced in as they come. Lines that didn't change at the
+    # start and end are skipped before diffing what's left.
+    new = list(new)
+    start = 0
+    for a, b in zip(old, new):
+        if a != b:
+            break
+        start += 1
+    end = 0
+    length = min(len(old), len(new)) - start
+    while end < length and old[len(old)-end-1] == new[len(new)-end-1]:
+        end += 1
+    a = old[start:len(old)-end]
+    b = new[start:len(new)-end]
+    hunks = []
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            hunks.append((start+i1, start+i2, b[j1:j2]))
+    return hunks[::-1]
+
+def merge_lines(base, ours, theirs):
+    # Hunks that bring the changes from base to theirs into ours, which has
+    # its own changes from base. None if both changed the same lines.
+    offsets = []
+    for start, stop, lines in diff_lines(base, ours)[::-1]:
+        offsets.append((start, stop, len(lines)-(stop-start)))
+    hunks = []
+    for start, stop, lines in diff_lines(base, theirs):
+        offset = 0
+        for our_start, our_stop, shift in offsets:
+            if start == our_start or (start < our_stop and our_start < stop):
+                return None
+            if our_stop <= start:
+                offset += shift
+        hunks.append((start+offset, stop+offset, lines))
+    return hunks
@@ -1,18 +1,58 @@
+import time
+START = time.perf_counter()
+
 import sys
+import argparse
+from panda3d.core import load_prc_file_data
 from direct.showbase.ShowBase import ShowBase
 from livecode.editor import TextEditorNode
+from livecode.scheduler import POLICIES
+from livecode.headless import fill_headless
 
 
 class Base(ShowBase):
-    def __init__(self):
+    def __init__(self, args):
+        if args.window_type:
+            load_prc_file_data('', 'window-type {}'.format(args.window_type))
+            if args.window_type != 'onscreen':
+                load_prc_file_data('', 'audio-library-name null')
         ShowBase.__init__(self)
-        self.win.set_clear_color((0.1,0.1,0.1,1))
+        fill_headless(self)
+        if self.win:
+            self.win.set_clear_color((0.1,0.1,0.1,1))
         self.accept('control-q', sys.exit)
-        self.text = TextEditorNode("Editor", "example/__init__.py")
+        if args.startup_time:
+            # Runs after igLoop, so once the first frame has been rendered.
+            # Added before the editor so the Repl leaves it alone.
+            self.task_mgr.add(self.report_startup, 'report startup', sort=60)
+        filenames = args.filenames or ["example/__init__.py"]
+        self.text = TextEditorNode(
+            "Editor", filenames[0], filenames[1:], run_delay=args.run_delay,
+            run_policy=args.run_policy, port=args.port,
+        )
         self.text_np= render2d.attach_new_node(self.text)
         self.text_np.set_scale(0.045)
         self.text_np.set_pos((-0.95,0,0.9))
 
+    def report_startup(self, task):
+        print('startup_ms: {:.1f}'.format((time.perf_counter()-START)*1000))
+        sys.exit()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Live-coding editor')
+    parser.add_argument('filenames', nargs='*')
+    parser.add_argument('--run-delay', type=float,
+        help='seconds to wait before running the loaded file')
+    parser.add_argument('--run-policy', choices=POLICIES, default='enter',
+        help='run the buffer on enter, once typing stops, or only when asked')
+    parser.add_argument('--startup-time', action='store_true',
+        help='print the time until the first frame and quit')
+    parser.add_argument('--window-type', help='onscreen, offscreen or none')
+    parser.add_argument('--port', type=int,
+        help='listen on this localhost port for code to run')
+    return parser.parse_args(args)
+
 if __name__ == "__main__":
-    base = Base()
+    base = Base(parse_args())
     base.run()
@@ -17,6 +17,11 @@ setuptools.setup(
     install_requires=[
         "panda3d>=1.10",
     ],
+    entry_points={
+        "console_scripts": [
+            "livecode-run=livecode.runner:main",
+        ],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: CC0 1.0 Universal (CC0 1.0) Public Domain Dedication",